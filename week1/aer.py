@@ -4,6 +4,18 @@ Check the test function below for an example of how to use these helper function
 
 For test results, please use the official AER perl script.
 """
+import os
+import numpy as np
+
+# bits of every position in a link key, see link_keys
+POSITION_BITS = 16
+
+# bytes of a NAACL file parsed at once by read_naacl_links
+CHUNK_BYTES = 1 << 24
+
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[list(b' \t\r\n\x0b\x0c')] = True
+
 
 def read_naacl_alignments(path):
     """
@@ -78,6 +90,298 @@ class AERSufficientStatistics:
         return 1 - (self.a_and_s + self.a_and_p) / (self.a + self.s)
 
 
+def _sorted_unique(keys):
+    """Sorted unique values of an int64 array, by sorting (faster than np.unique for large arrays of keys)"""
+    keys = np.sort(keys)
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+
+
+def link_keys(sentences, x, y):
+    """
+    Encode links as int64 keys that sort like the (sentence, x, y) tuples.
+
+    :param sentences: sentence index of every link
+    :param x: input position of every link, below 2 ** POSITION_BITS
+    :param y: output position of every link, below 2 ** POSITION_BITS
+    :return: an int64 array of keys
+    """
+    sentences, x, y = (np.asarray(a, dtype=np.int64) for a in (sentences, x, y))
+    return (sentences << (2 * POSITION_BITS)) | (x << POSITION_BITS) | y
+
+
+def gold_link_keys(gold_sets):
+    """
+    Convert the output of read_naacl_alignments to link keys, the n-th entry is sentence n.
+
+    :return: sorted unique keys of the sure links and of the possible links
+    """
+    keys = []
+    for k in (0, 1):
+        links = [(n, x, y) for n, gold in enumerate(gold_sets) for x, y in gold[k]]
+        links = np.array(links, dtype=np.int64).reshape(-1, 3)
+        keys.append(_sorted_unique(link_keys(links[:, 0], links[:, 1], links[:, 2])))
+    return keys[0], keys[1]
+
+
+def _parse_naacl_chunk(chunk, first_line):
+    """
+    Parse complete lines of a NAACL file without a Python loop over them.
+
+    Lines with fewer than three fields, a sentence id or position that is not a non-negative integer,
+    or a fifth field after a type other than S or P raise a ValueError with their line number.
+    :return: sentence ids, x, y and whether each link is sure
+    """
+    c = np.frombuffer(chunk, dtype=np.uint8)
+    space = _WHITESPACE[c]
+    line = np.cumsum(c == ord('\n')) - (c == ord('\n'))
+    starts = np.flatnonzero(~space & np.concatenate([[True], space[:-1]]))
+    ends = np.flatnonzero(~space & np.concatenate([space[1:], [True]])) + 1
+    if len(starts) == 0:
+        # only blank lines, which read_naacl_alignments skips as well
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0, dtype=bool)
+    token_line = line[starts]
+    # field index of every token within its line, and the number of fields of every line
+    first_token = np.flatnonzero(np.concatenate([[True], token_line[1:] != token_line[:-1]]))
+    n_fields = np.diff(np.append(first_token, len(starts)))
+    field = np.arange(len(starts)) - np.repeat(first_token, n_fields)
+
+    def fail(message, token):
+        bad = int(token_line[token])
+        text = bytes(chunk).split(b'\n')[bad].decode(errors='replace').strip()
+        raise ValueError('%s in line %d: %s' % (message, first_line + bad, text))
+
+    if len(n_fields) and n_fields.min() < 3:
+        fail('Missing required fields', first_token[n_fields.argmin()])
+
+    # the integer value of the first three tokens of every line
+    ints = np.flatnonzero(field < 3)
+    length = ends[ints] - starts[ints]
+    digits = np.repeat(starts[ints] - np.append(0, np.cumsum(length)[:-1]), length) + np.arange(length.sum())
+    is_digit = (c[digits] >= ord('0')) & (c[digits] <= ord('9'))
+    if not is_digit.all():
+        fail('Sentence id and positions must be non-negative integers', np.repeat(ints, length)[~is_digit][0])
+    place = 10 ** (np.repeat(ends[ints], length) - 1 - digits).astype(np.int64)
+    values = np.add.reduceat((c[digits].astype(np.int64) - ord('0')) * place, np.append(0, np.cumsum(length)[:-1]))
+    values = values.reshape(-1, 3)
+
+    # S is sure and P possible, a probability in the fourth of four fields leaves the link sure
+    sure = np.ones(len(first_token), dtype=bool)
+    has_type = n_fields >= 4
+    type_char = c[starts[first_token[has_type] + 3]]
+    single = ends[first_token[has_type] + 3] - starts[first_token[has_type] + 3] == 1
+    is_s = single & (type_char == ord('S'))
+    is_p = single & (type_char == ord('P'))
+    untyped = ~(is_s | is_p) & (n_fields[has_type] == 5)
+    if untyped.any():
+        fail('Link type must be S or P', first_token[has_type][untyped.argmax()])
+    sure[has_type] = is_s | (~is_p & (n_fields[has_type] == 4))
+    return values[:, 0], values[:, 1], values[:, 2], sure
+
+
+def read_naacl_links(path, cache_path=None):
+    """
+    Read a NAACL alignment file as link keys, the fast counterpart of read_naacl_alignments.
+
+    The file is parsed in chunks of CHUNK_BYTES.
+    :param cache_path: .npz file the keys are cached in, re-read while the alignment file is
+        not modified; None to always parse the file. A cache that cannot be written is skipped.
+    :return: sorted unique keys of the sure links and of the possible links (see link_keys), and the
+        number of sentences; sentences are numbered 0, 1, ... in the order of their ids,
+        like the entries returned by read_naacl_alignments
+    """
+    mtime = os.path.getmtime(path)
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            if data['mtime'] == mtime:
+                return data['sure'], data['probable'], int(data['n_sents'])
+
+    parts = []
+    with open(path, 'rb') as fi:
+        rest = b''
+        n_lines = 0
+        while True:
+            block = fi.read(CHUNK_BYTES)
+            chunk = rest + block
+            cut = len(chunk) if not block else chunk.rfind(b'\n') + 1
+            chunk, rest = chunk[:cut], chunk[cut:]
+            if chunk:
+                parts.append(_parse_naacl_chunk(chunk, n_lines))
+                n_lines += chunk.count(b'\n')
+            if not block:
+                break
+    snt_id, x, y, sure = (np.concatenate([p[k] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+                          for k in range(4))
+    ids = _sorted_unique(snt_id)
+    keys = link_keys(np.searchsorted(ids, snt_id), x, y)
+    sure_keys = _sorted_unique(keys[sure.astype(bool)])
+    probable_keys = _sorted_unique(keys)
+    if cache_path is not None:
+        try:
+            np.savez(cache_path, sure=sure_keys, probable=probable_keys, n_sents=len(ids), mtime=mtime)
+        except OSError:
+            pass
+    return sure_keys, probable_keys, len(ids)
+
+
+class LinkAERSufficientStatistics(AERSufficientStatistics):
+    """
+    AER sufficient statistics over link keys (see link_keys) instead of sets of tuples.
+
+    Any number of sentences is scored with a single call of update.
+    """
+
+    def update(self, sure, probable, predicted):
+        """
+        Update AER sufficient statistics for a batch of sentences.
+
+        :param sure: sorted unique keys of the sure links
+        :param probable: sorted unique keys of the probable links (must include sure links)
+        :param predicted: keys of the predicted links, duplicates are counted once
+        """
+        predicted = _sorted_unique(np.asarray(predicted, dtype=np.int64))
+        self.a_and_s += len(np.intersect1d(predicted, sure, assume_unique=True))
+        self.a_and_p += len(np.intersect1d(predicted, probable, assume_unique=True))
+        self.a += len(predicted)
+        self.s += len(sure)
+
+
+class SentenceAERSufficientStatistics(AERSufficientStatistics):
+    """
+    AER sufficient statistics kept per sentence, for breakdowns by sentence length and link type.
+
+    Links are given as keys (see link_keys), the counters of sentence n are column n of
+    preallocated arrays that grow as needed. Statistics of disjoint sets of sentences (e.g. the
+    shards of an evaluation) are combined with merge, which is associative. Every shard must only
+    be given the gold links of its own sentences, gold links passed to two shards count twice.
+    Only the first n_sents columns are in use, the rest is spare capacity.
+    """
+
+    # rows of counts
+    A_AND_S, A_AND_P, A, S, P = range(5)
+
+    def __init__(self, n_sents=0):
+        self.n_sents = n_sents
+        self.counts = np.zeros((5, n_sents), dtype=np.int64)
+        # length of every sentence, -1 while unknown
+        self.lengths = np.full(n_sents, -1, dtype=np.int64)
+
+    a_and_s = property(lambda self: int(self.counts[self.A_AND_S].sum()))
+    a_and_p = property(lambda self: int(self.counts[self.A_AND_P].sum()))
+    a = property(lambda self: int(self.counts[self.A].sum()))
+    s = property(lambda self: int(self.counts[self.S].sum()))
+
+    def __len__(self):
+        return self.n_sents
+
+    def _reserve(self, n_sents):
+        """Grow the arrays to hold at least n_sents sentences"""
+        capacity = self.counts.shape[1]
+        if n_sents > capacity:
+            size = max(n_sents, 2 * capacity)
+            counts = np.zeros((5, size), dtype=np.int64)
+            counts[:, :capacity] = self.counts
+            lengths = np.full(size, -1, dtype=np.int64)
+            lengths[:capacity] = self.lengths
+            self.counts, self.lengths = counts, lengths
+        self.n_sents = max(self.n_sents, n_sents)
+
+    def update(self, sure, probable, predicted, sentences=None, lengths=None):
+        """
+        Update the statistics of the sentences the links belong to.
+
+        :param sure: sorted unique keys of the sure links
+        :param probable: sorted unique keys of the probable links (must include sure links)
+        :param predicted: keys of the predicted links, duplicates are counted once
+        :param sentences: indices of the sentences whose lengths are given, all from 0 by default
+        :param lengths: length of those sentences, used by by_length
+        """
+        predicted = _sorted_unique(np.asarray(predicted, dtype=np.int64))
+        links = [np.intersect1d(predicted, sure, assume_unique=True),
+                 np.intersect1d(predicted, probable, assume_unique=True), predicted, sure, probable]
+        sents = [keys >> (2 * POSITION_BITS) for keys in links]
+        n_sents = max([int(s.max()) + 1 for s in sents if len(s)] + [0])
+        if lengths is not None:
+            sentences = np.arange(len(lengths)) if sentences is None else np.asarray(sentences)
+            n_sents = max(n_sents, int(sentences.max(initial=-1)) + 1)
+        self._reserve(n_sents)
+        for row, s in enumerate(sents):
+            self.counts[row, :n_sents] += np.bincount(s, minlength=n_sents)
+        if lengths is not None:
+            self.lengths[sentences] = lengths
+
+    def merge(self, other):
+        """
+        Return the combined statistics of self and other, neither is modified.
+
+        The counts of a sentence are added up, so self and other must hold different sentences
+        (and the gold links of their own sentences only) for the merged AER to be that of one pass.
+        """
+        merged = SentenceAERSufficientStatistics(max(len(self), len(other)))
+        for stats in (self, other):
+            n = len(stats)
+            merged.counts[:, :n] += stats.counts[:, :n]
+            merged.lengths[:n] = np.maximum(merged.lengths[:n], stats.lengths[:n])
+        return merged
+
+    @staticmethod
+    def _scores(counts):
+        """AER, precision and recall of summed counts, nan where undefined"""
+        a_and_s, a_and_p, a, s = (counts[k].astype(np.float64) for k in range(4))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1 - (a_and_s + a_and_p) / (a + s), a_and_p / a, a_and_s / s
+
+    def sentence_aer(self):
+        """AER of every sentence, nan for sentences without predicted or sure links"""
+        return self._scores(self.counts[:, :len(self)])[0]
+
+    def by_length(self, edges=(10, 20, 30, 40, 50)):
+        """
+        AER, precision and recall of the sentences with a known length in every length bucket.
+
+        :param edges: bucket boundaries, bucket k holds lengths in [edges[k - 1], edges[k])
+        :return: a list of (label, sentences, AER, precision, recall), one per bucket
+        """
+        known = self.lengths >= 0
+        bucket = np.digitize(self.lengths[known], edges)
+        n_buckets = len(edges) + 1
+        counts = np.stack([np.bincount(bucket, weights=row[known], minlength=n_buckets) for row in self.counts])
+        sents = np.bincount(bucket, minlength=n_buckets)
+        bounds = [0] + list(edges) + [None]
+        labels = ['{}-{}'.format(lo, hi - 1) if hi is not None else '{}+'.format(lo)
+                  for lo, hi in zip(bounds[:-1], bounds[1:])]
+        return list(zip(labels, sents.tolist(), *(score.tolist() for score in self._scores(counts))))
+
+    def by_link_type(self):
+        """
+        Recall of every gold link type and the share of predictions outside the gold links.
+
+        :return: a dict with the recall of the sure links, the recall of the possible (not sure) links,
+            and the fraction of predicted links that are neither
+        """
+        a_and_s, a_and_p, a, s, p = self.counts.sum(axis=1).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {'sure': a_and_s / s, 'possible': (a_and_p - a_and_s) / (p - s), 'wrong': (a - a_and_p) / a}
+
+    def report(self, edges=(10, 20, 30, 40, 50)):
+        """
+        Format AER, precision and recall overall, by length bucket and by link type.
+
+        Length buckets without sentences are left out and undefined scores are shown as '-'.
+        """
+        def score(value, width):
+            return '{:>{}}'.format('-', width) if np.isnan(value) else '{:>{}.4f}'.format(value, width)
+
+        lines = ['{:>8} {:>6} {:>7} {:>9} {:>7}'.format('length', 'sents', 'AER', 'precision', 'recall')]
+        total = self._scores(self.counts[:, :len(self)].sum(axis=1)[:, None])
+        rows = [row for row in self.by_length(edges) if row[1]] + [('all', len(self), *(x[0] for x in total))]
+        for label, n, aer_value, precision, recall in rows:
+            lines.append('{:>8} {:>6} {} {} {}'.format(label, n, score(aer_value, 7), score(precision, 9),
+                                                       score(recall, 7)))
+        lines.append(' '.join('{}: {}'.format(k, score(v, 0)) for k, v in self.by_link_type().items()))
+        return '\n'.join(lines)
+
+
 def test(path):
     from random import random
     # 1. Read in gold alignments
@@ -103,6 +407,14 @@ def test(path):
     # AER
     print(metric.aer())
 
+    # the same corpus-wide, with every link encoded as an int64 key
+    sure, probable = gold_link_keys(gold_sets)
+    predicted = np.array([(n, x, y) for n, links in enumerate(predictions) for x, y in links],
+                         dtype=np.int64).reshape(-1, 3)
+    metric = LinkAERSufficientStatistics()
+    metric.update(sure=sure, probable=probable, predicted=link_keys(*predicted.T))
+    print(metric.aer())
+
 
 if __name__ == '__main__':
     test('validation/dev.wa.nonullalign')
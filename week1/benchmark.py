@@ -0,0 +1,223 @@
+"""
+Throughput benchmark of the word alignment pipeline.
+
+Every stage (tokenization, init_theta, one IBM1 and one IBM2 E-step, the M-step,
+get_loglikelihood, compute_aer and reading the gold alignments) is timed on synthetic and
+real corpora of increasing size. Every (corpus, size) runs in a fresh process. The peak RSS of
+every stage is measured on its own on Linux, where the peak can be reset between stages, and
+the peak RSS of the whole process so far is kept as well. For every stage the scaling exponent is the slope of log(time) against log(size).
+Results are written as JSON, with the git revision of the engine, so runs can be compared.
+
+Example usage:
+    python benchmark.py --sizes 1000 10000 --output result/benchmark.json
+    python benchmark.py --en training/hansards.36.2.e --fr training/hansards.36.2.f
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import numpy as np
+import aer
+import ibm
+from corpus import read_sentences
+
+
+def synthetic_corpus(directory, n_sents, vocab_size=50000, max_length=40, seed=0):
+    """
+    Write a random parallel corpus with Zipf distributed words and random gold alignments.
+
+    :return: paths of the english, french and gold alignment files
+    """
+    rng = np.random.RandomState(seed)
+    paths = [os.path.join(directory, 'synthetic.' + ext) for ext in ('e', 'f', 'wa')]
+    with open(paths[0], 'w') as en, open(paths[1], 'w') as fr, open(paths[2], 'w') as gold:
+        for n in range(n_sents):
+            le, lf = rng.randint(1, max_length + 1, size=2)
+            words = np.minimum(rng.zipf(1.3, size=le + lf), vocab_size)
+            en.write(' '.join('e%d' % w for w in words[:le]) + '\n')
+            fr.write(' '.join('f%d' % w for w in words[le:]) + '\n')
+            for i in range(lf):
+                gold.write('{} {} {} {}\n'.format(n + 1, rng.randint(1, le + 1), i + 1, 'SP'[rng.randint(2)]))
+    return paths
+
+
+def real_corpus(directory, n_sents, en_path, fr_path, gold_path=None):
+    """
+    Write the first n_sents pairs of a real corpus, with the gold alignments of those sentences.
+
+    Without a gold file the first english word is taken as the gold link of every french word.
+    :return: paths of the english, french and gold alignment files
+    """
+    paths = [os.path.join(directory, 'real.' + ext) for ext in ('e', 'f', 'wa')]
+    for source, target in ((en_path, paths[0]), (fr_path, paths[1])):
+        with open(source, encoding='utf-8') as fi, open(target, 'w', encoding='utf-8') as fo:
+            for n, line in zip(range(n_sents), fi):
+                fo.write(line)
+    with open(paths[2], 'w') as gold:
+        if gold_path is not None:
+            with open(gold_path) as fi:
+                gold.writelines(line for line in fi if line.split() and int(line.split()[0]) <= n_sents)
+        else:
+            for n, sent in enumerate(read_sentences(paths[1])):
+                gold.writelines('{} 1 {} S\n'.format(n + 1, i + 1) for i in range(len(sent)))
+    return paths
+
+
+def _max_rss_mb():
+    """Peak RSS of this process since it started, or since the last _reset_peak_rss"""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def _reset_peak_rss():
+    """
+    Restart the peak RSS of the process (VmHWM in /proc/self/status, and ru_maxrss) from the current RSS.
+
+    :return: False where this is not possible (outside Linux)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_since_reset_mb():
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 2 ** 10
+    return None
+
+
+def run_stages(en_path, fr_path, gold_path):
+    """
+    Time every stage once on the given files.
+
+    :return: a list of {stage, seconds, stage_peak_rss_mb, process_peak_rss_mb}, the peak RSS while the stage
+        ran (including the memory held by earlier stages, None where it cannot be measured) and the peak RSS
+        of the process up to the end of the stage
+    """
+    results = []
+    # the peak RSS of the process, kept up to date by hand since resetting the stage peak resets ru_maxrss
+    process_peak = [0.]
+
+    def timed(stage, function, *args):
+        process_peak[0] = max(process_peak[0], _max_rss_mb())
+        reset = _reset_peak_rss()
+        start = time.perf_counter()
+        value = function(*args)
+        seconds = time.perf_counter() - start
+        stage_peak = _peak_rss_since_reset_mb() if reset else None
+        process_peak[0] = max(process_peak[0], _max_rss_mb(), stage_peak or 0.)
+        results.append({'stage': stage, 'seconds': seconds, 'stage_peak_rss_mb': stage_peak,
+                        'process_peak_rss_mb': process_peak[0]})
+        return value
+
+    en_train, fr_train = timed('tokenization', lambda: (read_sentences(en_path, null=True), read_sentences(fr_path)))
+    en_data = [sent[1:] for sent in en_train]
+    theta = timed('init_theta', ibm.init_theta, en_train, fr_train)
+    corpus = timed('pack', theta.encode, en_train, fr_train)
+    count_f_e, _, _, _ = timed('ibm1_e_step', ibm.e_step, theta, corpus)
+    theta_jump, _ = ibm.theta_jump_init(corpus)
+    timed('ibm2_e_step', ibm.e_step, theta, corpus, theta_jump)
+    timed('m_step', ibm.m_step, theta, count_f_e)
+    timed('get_loglikelihood', ibm.get_loglikelihood, en_train, fr_train, theta)
+    timed('compute_aer', ibm.compute_aer, en_data, fr_train, gold_path, theta)
+    timed('read_naacl_alignments', aer.read_naacl_alignments, gold_path)
+    timed('read_naacl_links', aer.read_naacl_links, gold_path)
+    return results
+
+
+def _run_child(conn, paths):
+    conn.send(run_stages(*paths))
+    conn.close()
+
+
+def benchmark(name, size, make_corpus):
+    """Write a corpus of the given size and time its stages in a fresh process"""
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_corpus(directory, size)
+        with open(paths[0], encoding='utf-8') as file:
+            n_sents = sum(1 for _ in file)
+        receiver, sender = mp.Pipe(duplex=False)
+        process = mp.Process(target=_run_child, args=(sender, paths))
+        process.start()
+        sender.close()
+        results = receiver.recv()
+        process.join()
+    print('{:>9} {:>8} {:>22} {:>10} {:>20} {:>16} {:>18}'.format(
+        'corpus', 'size', 'stage', 'time', 'throughput', 'stage peak RSS', 'process peak RSS'))
+    for result in results:
+        result.update(corpus=name, size=n_sents, sents_per_sec=n_sents / max(result['seconds'], 1e-9))
+        stage_peak = result['stage_peak_rss_mb']
+        print('{corpus:>9} {size:>8} {stage:>22} {seconds:9.3f}s {sents_per_sec:12.0f} sents/s '
+              '{stage_peak:>13} MB {process_peak_rss_mb:15.1f} MB'.format(
+                  stage_peak='-' if stage_peak is None else '{:.1f}'.format(stage_peak), **result))
+    return results
+
+
+def scaling_exponents(results):
+    """Slope of log(seconds) against log(size) of every corpus and stage measured at two or more sizes"""
+    exponents = {}
+    for name in sorted({r['corpus'] for r in results}):
+        exponents[name] = {}
+        for stage in dict.fromkeys(r['stage'] for r in results if r['corpus'] == name):
+            points = [(r['size'], r['seconds']) for r in results
+                      if r['corpus'] == name and r['stage'] == stage and r['seconds'] > 0]
+            if len({size for size, _ in points}) >= 2:
+                size, seconds = np.log(np.array(points)).T
+                exponents[name][stage] = float(np.polyfit(size, seconds, 1)[0])
+    return exponents
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(config):
+    results = []
+    for size in config.sizes:
+        if config.synthetic:
+            results += benchmark('synthetic', size, lambda directory, n: synthetic_corpus(directory, n))
+        if config.en and config.fr:
+            results += benchmark('real', size, lambda directory, n: real_corpus(directory, n, config.en, config.fr,
+                                                                                config.gold))
+    exponents = scaling_exponents(results)
+    for name, stages in exponents.items():
+        if stages:
+            print('scaling exponents ({}): '.format(name)
+                  + ', '.join('{} {:.2f}'.format(k, v) for k, v in stages.items()))
+
+    report = {'revision': _revision(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'cpus': os.cpu_count(), 'config': vars(config),
+              'results': results, 'scaling_exponents': exponents}
+    if os.path.dirname(config.output):
+        os.makedirs(os.path.dirname(config.output), exist_ok=True)
+    with open(config.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('results written to', config.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help='Numbers of sentence pairs to benchmark')
+    parser.add_argument('--en', type=str, default=None, help='English side of a real corpus')
+    parser.add_argument('--fr', type=str, default=None, help='French side of a real corpus')
+    parser.add_argument('--gold', type=str, default=None, help='NAACL gold alignments of the real corpus')
+    parser.add_argument('--no_synthetic', dest='synthetic', action='store_false',
+                        help='Only benchmark the real corpus')
+    parser.add_argument('--output', type=str, default='result/benchmark.json', help='JSON file of the results')
+    main(parser.parse_args())
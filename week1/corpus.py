@@ -0,0 +1,327 @@
+"""
+Integer-id parallel corpora for the IBM models in ibm.py.
+
+A Corpus stores a tokenized parallel corpus as flat int32 id arrays with sentence offsets.
+Corpus.pack groups its sentence pairs by (french, english) length into padded buckets, so
+that the E-step of a whole bucket is a single (sentences, I, J) gather from theta.
+pack_files reads, tokenizes and packs a pair of files once and caches the result on disk.
+For corpora that do not fit in memory, convert_files writes the flat id arrays as .npy
+files once, and Corpus.open memory-maps them so EM can stream over fixed-size chunks.
+
+Example usage:
+    from corpus import pack_files
+    train = pack_files('./training/hansards.36.2.e', './training/hansards.36.2.f',
+                       './training/hansards.36.2.npz')
+
+    from corpus import convert_files, Corpus
+    convert_files('./training/hansards.36.2.e', './training/hansards.36.2.f', './training/hansards')
+    train = Corpus.open('./training/hansards')
+"""
+import os
+from array import array
+import numpy as np
+
+# token prepended to every english training sentence
+NULL = 'NULLINDICATOR'
+
+# upper bound on sentences * I * J of a bucket, which bounds the memory of one E-step gather
+BUCKET_PAIRS = 1 << 20
+
+# sentence pairs packed at once when streaming over a Corpus
+CHUNK_SIZE = 50000
+
+# files written by convert_files
+_ARRAYS = ('en_ids', 'en_offsets', 'fr_ids', 'fr_offsets')
+
+
+class Vocabulary:
+    """A vocabulary, assigns IDs to words in sorted order"""
+
+    def __init__(self, words):
+        self.i2w = sorted(set(words))
+        self.w2i = {w: i for i, w in enumerate(self.i2w)}
+
+    def __len__(self):
+        return len(self.i2w)
+
+    def encode(self, sentence):
+        """Map a tokenized sentence to an int32 id array, unknown words get id -1"""
+        return np.array([self.w2i.get(w, -1) for w in sentence], dtype=np.int32)
+
+
+class Corpus:
+    """
+    A tokenized parallel corpus stored as flat int32 id arrays.
+
+    Sentence n spans en_ids[en_offsets[n]:en_offsets[n + 1]], likewise for french.
+    The arrays may be memory-mapped (see Corpus.open), then only the chunk being packed
+    is ever read into memory.
+    """
+
+    def __init__(self, en_vocab, fr_vocab, en_ids, en_offsets, fr_ids, fr_offsets,
+                 chunk_size=CHUNK_SIZE, path=None):
+        self.en_vocab = en_vocab
+        self.fr_vocab = fr_vocab
+        self.en_ids = en_ids
+        self.en_offsets = en_offsets
+        self.fr_ids = fr_ids
+        self.fr_offsets = fr_offsets
+        self.chunk_size = chunk_size
+        self.path = path
+
+    @classmethod
+    def open(cls, path, chunk_size=CHUNK_SIZE):
+        """Memory-map a corpus written by convert_files"""
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in _ARRAYS]
+        vocabs = [Vocabulary(np.load(os.path.join(path, name + '.npy')).tolist())
+                  for name in ('en_vocab', 'fr_vocab')]
+        return cls(*vocabs, *arrays, chunk_size=chunk_size, path=path)
+
+    def __getstate__(self):
+        # a memory-mapped corpus is sent to other processes by path instead of by content
+        if self.path is not None:
+            return {'path': self.path, 'chunk_size': self.chunk_size}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'en_ids' not in state:
+            state = Corpus.open(state['path'], state['chunk_size']).__dict__
+        self.__dict__.update(state)
+
+    @classmethod
+    def from_sentences(cls, en_sents, fr_sents, en_vocab, fr_vocab):
+        en_ids, en_offsets = _flatten(en_sents, en_vocab)
+        fr_ids, fr_offsets = _flatten(fr_sents, fr_vocab)
+        return cls(en_vocab, fr_vocab, en_ids, en_offsets, fr_ids, fr_offsets)
+
+    def __len__(self):
+        return len(self.en_offsets) - 1
+
+    @property
+    def max_length(self):
+        """Length of the longest english or french sentence"""
+        return max(0, int(np.diff(self.en_offsets).max(initial=0)), int(np.diff(self.fr_offsets).max(initial=0)))
+
+    def chunks(self):
+        """Split the corpus into (start, stop) ranges of at most chunk_size sentence pairs"""
+        return [(start, min(start + self.chunk_size, len(self))) for start in range(0, len(self), self.chunk_size)]
+
+    def shard_buckets(self, chunk):
+        """Pack one (start, stop) chunk and return its buckets"""
+        return self.pack(start=chunk[0], stop=chunk[1]).buckets
+
+    def pack(self, bucket_width=1, start=0, stop=None):
+        """
+        Group the sentence pairs in [start, stop) into buckets of equal padded lengths.
+
+        :param bucket_width: lengths are padded up to a multiple of this,
+            1 gives buckets of exactly equal lengths
+        :return: a PackedCorpus, its buckets refer to sentences by their index in this corpus
+        """
+        stop = len(self) if stop is None else stop
+        le = np.diff(self.en_offsets[start:stop + 1])
+        lf = np.diff(self.fr_offsets[start:stop + 1])
+        J = -(-le // bucket_width) * bucket_width
+        I = -(-lf // bucket_width) * bucket_width
+        order = np.lexsort((J, I))
+        cut = np.flatnonzero((np.diff(I[order]) != 0) | (np.diff(J[order]) != 0)) + 1
+        buckets = []
+        for sents in np.split(order, cut):
+            if len(sents) == 0:
+                continue
+            size = max(1, BUCKET_PAIRS // max(1, I[sents[0]] * J[sents[0]]))
+            for begin in range(0, len(sents), size):
+                part = sents[begin:begin + size]
+                buckets.append(Bucket(start + part,
+                                      _pad(self.en_ids, self.en_offsets, start + part, J[part[0]]),
+                                      _pad(self.fr_ids, self.fr_offsets, start + part, I[part[0]]),
+                                      le[part], lf[part]))
+        return PackedCorpus(self.en_vocab, self.fr_vocab, buckets, len(self))
+
+
+def _flatten(sents, vocab):
+    lengths = np.array([len(s) for s in sents], dtype=np.int64)
+    offsets = np.zeros(len(sents) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = np.array([vocab.w2i.get(w, -1) for s in sents for w in s], dtype=np.int32)
+    return ids, offsets
+
+
+def _pad(ids, offsets, sents, length):
+    """Ids of the given sentences as a (len(sents), length) array padded with -1"""
+    idx = np.asarray(offsets[sents])[:, None] + np.arange(length)
+    mask = idx < np.asarray(offsets[sents + 1])[:, None]
+    padded = np.full(idx.shape, -1, dtype=np.int32)
+    padded[mask] = ids[idx[mask]]
+    return padded
+
+
+class Bucket:
+    """
+    Sentence pairs padded to a common (french, english) length.
+
+    e and f are (sentences, J) and (sentences, I) int32 id arrays padded with -1,
+    le and lf are the real lengths and sents the indices of the pairs in the corpus.
+    """
+
+    def __init__(self, sents, e, f, le, lf):
+        self.sents = sents
+        self.e = e
+        self.f = f
+        self.le = le
+        self.lf = lf
+        self.e_mask = np.arange(e.shape[1]) < le[:, None]
+        self.f_mask = np.arange(f.shape[1]) < lf[:, None]
+
+    def __len__(self):
+        return len(self.sents)
+
+    @property
+    def shape(self):
+        """(sentences, I, J)"""
+        return len(self.sents), self.f.shape[1], self.e.shape[1]
+
+    @property
+    def exact(self):
+        """Whether every pair has exactly the padded lengths"""
+        return bool(self.e_mask.all() and self.f_mask.all())
+
+
+class PackedCorpus:
+    """A parallel corpus grouped into padded length buckets, see Corpus.pack"""
+
+    def __init__(self, en_vocab, fr_vocab, buckets, n_sents):
+        self.en_vocab = en_vocab
+        self.fr_vocab = fr_vocab
+        self.buckets = buckets
+        self.n_sents = n_sents
+
+    def __len__(self):
+        return self.n_sents
+
+    @property
+    def max_length(self):
+        """Length of the longest english or french sentence"""
+        return max([0] + [max(b.le.max(), b.lf.max()) for b in self.buckets if len(b)])
+
+    def shard_buckets(self, shard):
+        """Buckets of a shard, see shards"""
+        return [self.buckets[k] for k in shard]
+
+    def shards(self, n):
+        """Split the buckets into at most n lists of bucket indices with about the same number of pairs"""
+        load = np.zeros(n)
+        shards = [[] for _ in range(n)]
+        cost = [np.prod(b.shape) for b in self.buckets]
+        for k in np.argsort(cost)[::-1]:
+            shard = int(load.argmin())
+            shards[shard].append(int(k))
+            load[shard] += cost[k]
+        return [s for s in shards if s]
+
+    def save(self, path, paths=(), mtimes=(), bucket_width=0):
+        """
+        Save to an .npz file.
+
+        The absolute paths and mtimes of the source files and the bucket width they were packed with
+        are stored to validate the cache, see pack_files.
+        """
+        arrays = {'en_vocab': np.array(self.en_vocab.i2w), 'fr_vocab': np.array(self.fr_vocab.i2w),
+                  'n_sents': self.n_sents, 'n_buckets': len(self.buckets), 'paths': np.array(paths, dtype=str),
+                  'mtimes': np.array(mtimes, dtype=np.float64), 'bucket_width': bucket_width}
+        for k, b in enumerate(self.buckets):
+            arrays.update({'sents_%d' % k: b.sents, 'e_%d' % k: b.e, 'f_%d' % k: b.f,
+                           'le_%d' % k: b.le, 'lf_%d' % k: b.lf})
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            buckets = [Bucket(*(data['%s_%d' % (name, k)] for name in ('sents', 'e', 'f', 'le', 'lf')))
+                       for k in range(int(data['n_buckets']))]
+            return cls(Vocabulary(data['en_vocab'].tolist()), Vocabulary(data['fr_vocab'].tolist()),
+                       buckets, int(data['n_sents']))
+
+
+def iter_lines(file):
+    """
+    Lines of a text file split as file.read().splitlines() does, without reading the whole file.
+
+    Iterating over a file only splits at '\n', splitlines also splits at '\x85', '\u2028', etc.
+    """
+    for line in file:
+        yield from line.splitlines()
+
+
+def read_sentences(path, null=False):
+    """Read a file of whitespace tokenized sentences, optionally prepending the NULL token"""
+    with open(path, mode='r', encoding='utf-8') as file:
+        return [([NULL] if null else []) + line.split() for line in iter_lines(file)]
+
+
+def pack_files(en_path, fr_path, cache_path=None, bucket_width=1):
+    """
+    Read, tokenize and pack a parallel training corpus, the NULL token is added to english.
+
+    :param cache_path: .npz file the packed corpus is cached in, it is rebuilt when it was written
+        for other source files or another bucket_width, or either source file was modified since
+    :return: a PackedCorpus with vocabularies built from the corpus itself
+    """
+    paths = [os.path.abspath(en_path), os.path.abspath(fr_path)]
+    mtimes = [os.path.getmtime(en_path), os.path.getmtime(fr_path)]
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            fresh = ('paths' in cache and cache['paths'].tolist() == paths and
+                     np.array_equal(cache['mtimes'], mtimes) and int(cache['bucket_width']) == bucket_width)
+        if fresh:
+            return PackedCorpus.load(cache_path)
+
+    en_sents = read_sentences(en_path, null=True)
+    fr_sents = read_sentences(fr_path)
+    en_vocab = Vocabulary(w for s in en_sents for w in s)
+    fr_vocab = Vocabulary(w for s in fr_sents for w in s)
+    packed = Corpus.from_sentences(en_sents, fr_sents, en_vocab, fr_vocab).pack(bucket_width)
+    if cache_path is not None:
+        packed.save(cache_path, paths, mtimes, bucket_width)
+    return packed
+
+
+def convert_files(en_path, fr_path, path):
+    """
+    Convert a parallel training corpus to flat int32 id arrays in .npy files, for Corpus.open.
+
+    The files are read twice, once for the vocabularies and lengths and once for the ids,
+    so memory use is proportional to the vocabularies rather than to the text.
+    The NULL token is added to english. Lines are split as in read_sentences.
+    :param path: directory the arrays and the sorted vocabularies are written to
+    :return: the memory-mapped Corpus
+    """
+    os.makedirs(path, exist_ok=True)
+    n_lines = []
+    for name, text_path, null in (('en', en_path, True), ('fr', fr_path, False)):
+        words = set([NULL] if null else [])
+        lengths = array('q')
+        with open(text_path, mode='r', encoding='utf-8') as file:
+            for line in iter_lines(file):
+                tokens = line.split()
+                words.update(tokens)
+                lengths.append(len(tokens) + null)
+        n_lines.append(len(lengths))
+        if n_lines[0] != n_lines[-1]:
+            raise ValueError('%s has %d lines but %s has %d' % (en_path, n_lines[0], fr_path, n_lines[-1]))
+        vocab = Vocabulary(words)
+        np.save(os.path.join(path, name + '_vocab.npy'), np.array(vocab.i2w))
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(lengths, dtype=np.int64), out=offsets[1:])
+        np.save(os.path.join(path, name + '_offsets.npy'), offsets)
+
+        ids = np.lib.format.open_memmap(os.path.join(path, name + '_ids.npy'), mode='w+',
+                                        dtype=np.int32, shape=(int(offsets[-1]),))
+        with open(text_path, mode='r', encoding='utf-8') as file:
+            for n, line in enumerate(iter_lines(file)):
+                tokens = ([NULL] if null else []) + line.split()
+                ids[offsets[n]:offsets[n + 1]] = [vocab.w2i[w] for w in tokens]
+        ids.flush()
+        del ids
+    return Corpus.open(path)
@@ -0,0 +1,1225 @@
+"""
+Vectorized engine for the IBM1 and IBM2 alignment models of ibm_models.ipynb.
+
+Both vocabularies are mapped to integer ids and the translation table theta is a
+CSR matrix of float64 probabilities over the (english, french) pairs that co-occur
+in the training corpus. The corpus is packed into length buckets (see corpus.py) and
+the E-step of a bucket is one (sentences, I, J) gather/scatter instead of a Python loop
+over every word pair.
+
+Example usage:
+    import ibm
+    theta = ibm.init_theta(en_train, fr_train)
+    theta, AER, t_log, iteration = ibm.train_EM(en_train, fr_train, theta, en_val, fr_val,
+                                                en_test, fr_test, path_val, K=10)
+    ibm.write_naacl(ibm.align(theta, theta.encode(en_test, fr_test)), 'result/ibm1.mle')
+"""
+import functools
+import heapq
+import json
+import multiprocessing as mp
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import aer
+from aer import read_naacl_alignments
+from corpus import NULL, Corpus, PackedCorpus, Vocabulary
+
+# pairs of (french, english) positions scattered into the count arrays at once
+FLUSH_SIZE = 1 << 22
+
+# pending pair keys merged at once when building a translation table
+BUCKET_KEYS = 1 << 24
+
+class Numerics:
+    """
+    How the model probabilities are stored: 'float32', 'float64' or 'log-float64'.
+
+    In log-float64 theta and the jump table hold log probabilities, and the posteriors of a
+    french word are rescaled by their maximum before exponentiating, so long products never underflow.
+    Expected counts are always accumulated in float64.
+    """
+
+    NAMES = ('float32', 'float64', 'log-float64')
+
+    def __init__(self, name='float64'):
+        if name not in self.NAMES:
+            raise ValueError('Unknown numerics %r, expected one of %s' % (name, ', '.join(self.NAMES)))
+        self.name = name
+        self.log = name.startswith('log')
+        self.dtype = np.float32 if name == 'float32' else np.float64
+        self.zero = -np.inf if self.log else 0.
+
+    def encode(self, p):
+        """Convert probabilities to the stored representation"""
+        with np.errstate(divide='ignore'):
+            return (np.log(p) if self.log else np.asarray(p)).astype(self.dtype)
+
+    def decode(self, x):
+        """Convert stored values back to float64 probabilities"""
+        return np.exp(x) if self.log else np.asarray(x, dtype=np.float64)
+
+    def scaled(self, x, axis):
+        """
+        Probabilities proportional to x along axis, safe to normalize over that axis.
+
+        :return: the rescaled probabilities and the log of the factor they were divided by
+        """
+        if not self.log:
+            return x, 0.
+        m = x.max(axis=axis, keepdims=True)
+        m = np.where(np.isfinite(m), m, 0.)
+        return np.exp(x - m), m
+
+
+class TranslationTable:
+    """
+    Translation probabilities p(f|e) stored as a CSR matrix.
+
+    Row e holds the sorted french ids indices[indptr[e]:indptr[e + 1]] and their
+    probabilities data[indptr[e]:indptr[e + 1]], stored as described by numerics.
+    Pairs outside the table have probability 0.
+    """
+
+    def __init__(self, en_vocab, fr_vocab, indptr, indices, data, numerics=None, keys=None):
+        self.en_vocab = en_vocab
+        self.fr_vocab = fr_vocab
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.numerics = Numerics() if numerics is None else numerics
+        self._rows = None
+        # linear key of every stored pair, sorted because rows and indices are
+        self.keys = self.rows * len(fr_vocab) + indices if keys is None else keys
+
+    @property
+    def rows(self):
+        """English id of every stored pair, built on first use"""
+        if self._rows is None:
+            self._rows = np.repeat(np.arange(len(self.en_vocab), dtype=np.int64), np.diff(self.indptr))
+        return self._rows
+
+    def __len__(self):
+        return len(self.en_vocab)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def lookup(self, e, f):
+        """Return the position in data of every (e, f) pair, -1 for pairs not in the table"""
+        keys = e.astype(np.int64) * len(self.fr_vocab) + f
+        pos = np.minimum(np.searchsorted(self.keys, keys), self.nnz - 1)
+        found = (self.keys[pos] == keys) & (e >= 0) & (f >= 0)
+        return np.where(found, pos, -1)
+
+    def get(self, e, f):
+        """Return p(f|e) for arrays of english and french ids, in the stored representation"""
+        pos = self.lookup(e, f)
+        return np.where(pos >= 0, self.data[pos], self.numerics.zero)
+
+    @property
+    def nbytes(self):
+        """Memory held by the table arrays"""
+        arrays = [self.indptr, self.indices, self.data, self.keys] + ([] if self._rows is None else [self._rows])
+        return sum(a.nbytes for a in arrays)
+
+    def prune(self, floor=None, top_k=None):
+        """
+        Drop small entries in place and renormalize every row.
+
+        The most probable french word of every english word is always kept, so no row becomes empty.
+        :param floor: drop entries with p(f|e) below this probability
+        :param top_k: keep only the k most probable french words of every english word
+        :return: the number of entries dropped
+        """
+        p = self.numerics.decode(self.data)
+        # rank of every entry within its row, most probable first
+        order = np.lexsort((-p, self.rows))
+        rank = np.empty(self.nnz, dtype=np.int64)
+        rank[order] = np.arange(self.nnz) - self.indptr[self.rows[order]]
+        keep = np.ones(self.nnz, dtype=bool)
+        if floor is not None:
+            keep &= (p >= floor) | (rank == 0)
+        if top_k is not None:
+            keep &= rank < max(top_k, 1)
+        dropped = self.nnz - int(keep.sum())
+        if dropped == 0:
+            return 0
+        rows = self.rows[keep]
+        p = p[keep]
+        count_e = np.bincount(rows, weights=p, minlength=len(self))
+        self.indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self)), out=self.indptr[1:])
+        self.indices = self.indices[keep]
+        self.keys = self.keys[keep]
+        self._rows = rows
+        self.data = self.numerics.encode(p / count_e[rows])
+        return dropped
+
+    def grow(self, en_sents, fr_sents):
+        """
+        Add the words and co-occurring pairs of new sentences in place.
+
+        The vocabularies stay sorted, so old ids may move but keep their order and the keys stay sorted.
+        New pairs get probability 1 / #pairs of their english word, after which the rows they were
+        added to are renormalized.
+        :return: new english ids of the old english ids, and new positions of the old entries in data
+        """
+        en_vocab = Vocabulary(self.en_vocab.i2w + [w for s in en_sents for w in s])
+        fr_vocab = Vocabulary(self.fr_vocab.i2w + [w for s in fr_sents for w in s])
+        en_map = np.array([en_vocab.w2i[w] for w in self.en_vocab.i2w], dtype=np.int64)
+        fr_map = np.array([fr_vocab.w2i[w] for w in self.fr_vocab.i2w], dtype=np.int64)
+        old_keys = en_map[self.rows] * len(fr_vocab) + fr_map[self.indices]
+        batch = TranslationTable.from_corpus(Corpus.from_sentences(en_sents, fr_sents, en_vocab, fr_vocab).pack())
+        keys = np.union1d(old_keys, batch.keys)
+        old_pos = np.searchsorted(keys, old_keys)
+        if len(keys) == self.nnz and len(en_vocab) == len(self.en_vocab) and len(fr_vocab) == len(self.fr_vocab):
+            return en_map, old_pos
+
+        rows = keys // len(fr_vocab)
+        indptr = np.zeros(len(en_vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(en_vocab)), out=indptr[1:])
+        new = np.ones(len(keys), dtype=bool)
+        new[old_pos] = False
+        p = np.zeros(len(keys))
+        p[old_pos] = self.numerics.decode(self.data)
+        p[new] = 1 / np.diff(indptr)[rows[new]]
+        changed = np.bincount(rows[new], minlength=len(en_vocab)) > 0
+        row_sum = np.bincount(rows, weights=p, minlength=len(en_vocab))
+        p = np.where(changed[rows], p / row_sum[rows], p)
+
+        self.en_vocab, self.fr_vocab = en_vocab, fr_vocab
+        self.indptr = indptr
+        self.indices = (keys % len(fr_vocab)).astype(np.int32)
+        self.keys = keys
+        self._rows = rows
+        self.data = self.numerics.encode(p)
+        return en_map, old_pos
+
+    def set_numerics(self, name):
+        """Convert the stored probabilities to another Numerics in place"""
+        numerics = Numerics(name)
+        if numerics.name != self.numerics.name:
+            self.data = numerics.encode(self.numerics.decode(self.data))
+            self.numerics = numerics
+        return self
+
+    def encode(self, en_sents, fr_sents):
+        """Encode and pack tokenized sentences with the vocabularies of this table"""
+        return Corpus.from_sentences(en_sents, fr_sents, self.en_vocab, self.fr_vocab).pack()
+
+    @classmethod
+    def from_corpus(cls, corpus):
+        """
+        Build a uniform translation table over every co-occurring (english, french) pair.
+
+        :param corpus: a PackedCorpus or a (memory-mapped) Corpus, its vocabularies become those of the table
+        :return: a TranslationTable with p(f|e) = 1 / #french words co-occurring with e
+        """
+        n_fr = len(corpus.fr_vocab)
+        keys = np.zeros(0, dtype=np.int64)
+        pending = []
+        for bucket in _buckets(corpus):
+            mask = bucket.f_mask[:, :, None] & bucket.e_mask[:, None, :]
+            pairs = bucket.e[:, None, :].astype(np.int64) * n_fr + bucket.f[:, :, None]
+            pending.append(np.unique(pairs[mask]))
+            # merge once the pending keys outgrow the merged ones, so memory stays proportional to theta
+            if sum(len(k) for k in pending) > max(len(keys), BUCKET_KEYS):
+                keys = np.unique(np.concatenate([keys] + pending))
+                pending = []
+        keys = np.unique(np.concatenate([keys] + pending))
+
+        rows = keys // n_fr
+        indices = (keys % n_fr).astype(np.int32)
+        indptr = np.zeros(len(corpus.en_vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(corpus.en_vocab)), out=indptr[1:])
+        data = 1 / np.diff(indptr)[rows]
+        return cls(corpus.en_vocab, corpus.fr_vocab, indptr, indices, data)
+
+
+def init_theta(en_train, fr_train):
+    """
+    Build a uniform translation table over every co-occurring (english, french) pair.
+
+    :param en_train: tokenized english sentences (including the NULL token)
+    :param fr_train: tokenized french sentences
+    :return: a TranslationTable with p(f|e) = 1 / #french words co-occurring with e
+    """
+    en_vocab = Vocabulary(w for s in en_train for w in s)
+    fr_vocab = Vocabulary(w for s in fr_train for w in s)
+    return TranslationTable.from_corpus(Corpus.from_sentences(en_train, fr_train, en_vocab, fr_vocab).pack())
+
+
+# jump matrices kept by jump_matrix, enough for every (I, J) of a corpus of sentences
+# of up to 64 words, while bounding memory on corpora with longer outliers
+JUMP_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=JUMP_CACHE_SIZE)
+def jump_matrix(I, J):
+    """
+    Jump i - floor(I * j / J) of every french position i and english position j.
+
+    :param I: french sentence length
+    :param J: english sentence length
+    :return: an (I, J) read-only int64 array, cached for the JUMP_CACHE_SIZE most recent (I, J)
+    """
+    jumps = np.arange(I)[:, None] - I * np.arange(J)[None, :] // J
+    jumps.flags.writeable = False
+    return jumps
+
+
+class _Scatter:
+    """Adds weights into a dense count array, buffering positions to scatter them in large batches"""
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.pos = []
+        self.weights = []
+        self.size = 0
+
+    def add(self, pos, weights):
+        self.pos.append(pos.ravel())
+        self.weights.append(weights.ravel())
+        self.size += pos.size
+        if self.size >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pos:
+            self.counts += np.bincount(np.concatenate(self.pos), weights=np.concatenate(self.weights),
+                                       minlength=len(self.counts))
+        self.pos, self.weights, self.size = [], [], 0
+        return self.counts
+
+
+def _bucket_jumps(bucket, max_jump):
+    """Jump of every (sentence, french position, english position) of a bucket, offset by max_jump"""
+    B, I, J = bucket.shape
+    if bucket.exact:
+        return jump_matrix(I, J)[None] + max_jump
+    jumps = np.arange(I)[None, :, None] - bucket.lf[:, None, None] * np.arange(J) // np.maximum(bucket.le, 1)[:, None, None]
+    mask = bucket.f_mask[:, :, None] & bucket.e_mask[:, None, :]
+    return np.where(mask, jumps, 0) + max_jump
+
+
+def posteriors(theta, bucket, theta_jump=None):
+    """
+    Alignment posteriors of every french token of a bucket.
+
+    The normalizer Z of every french token gives the sentence log-likelihood
+    log(lf / le) + sum_i log(sum_j p(f_i|e_j) a(j|i)) as a by-product, with a(j|i) = 1 / le
+    for IBM1 and the jump probability for IBM2. The constant log(lf / le) is the one of get_loglikelihood.
+    A french token whose every link was pruned from theta has Z = 0, it is left out of the sum
+    and counted instead, so the log-likelihood stays finite and comparable between iterations.
+    :param theta_jump: jump probabilities for IBM2, None for IBM1
+    :return: positions of the pairs in theta.data (-1 outside the table and at padding),
+        the (sentences, I, J) posteriors normalized over english, the offset jumps (None for IBM1),
+        the log-likelihood of every sentence and its number of tokens with probability 0
+    """
+    # theta[e_ids[:, None, :], f_ids[:, :, None]], padding has id -1 and gets probability 0
+    numerics = theta.numerics
+    pos = theta.lookup(bucket.e[:, None, :], bucket.f[:, :, None])
+    p = np.where(pos >= 0, theta.data[pos], numerics.zero)
+    jumps = None
+    if theta_jump is not None:
+        jumps = _bucket_jumps(bucket, len(theta_jump) // 2)
+        p = p + theta_jump[jumps] if numerics.log else p * theta_jump[jumps]
+    p, log_scale = numerics.scaled(p, axis=2)
+    Z = p.sum(axis=2, keepdims=True)
+    c = np.divide(p, Z, out=np.zeros_like(p), where=Z > 0)
+
+    le, lf = bucket.le, bucket.lf
+    with np.errstate(divide='ignore'):
+        log_Z = (np.log(Z, dtype=np.float64) + log_scale)[:, :, 0]
+    found = bucket.f_mask & (Z[:, :, 0] > 0)
+    zero_tokens = lf - found.sum(axis=1)
+    log_Z = np.where(found, log_Z, 0.).sum(axis=1)
+    if theta_jump is None:
+        log_Z -= (lf - zero_tokens) * np.log(le)
+    return pos, c, jumps, np.log(lf / le) + log_Z, zero_tokens
+
+
+def _shards(corpus, workers=1):
+    """Units of E-step work: lists of bucket indices of a PackedCorpus, or the chunks of a streamed Corpus"""
+    if isinstance(corpus, PackedCorpus):
+        return corpus.shards(workers)
+    return corpus.chunks()
+
+
+def _buckets(corpus):
+    """Every bucket of a corpus, a streamed Corpus is packed one chunk at a time"""
+    for shard in _shards(corpus):
+        for bucket in corpus.shard_buckets(shard):
+            yield bucket
+
+
+def _shard_counts(theta, corpus, shard, theta_jump=None):
+    """Expected counts, log-likelihood and zero-probability tokens of one shard of the corpus, see e_step"""
+    scatter = _Scatter(np.zeros(theta.nnz))
+    count_jump = None if theta_jump is None else np.zeros(len(theta_jump))
+    loglikelihood = 0.
+    zero_tokens = 0
+    for bucket in corpus.shard_buckets(shard):
+        pos, c, jumps, sent_loglikelihood, sent_zero_tokens = posteriors(theta, bucket, theta_jump)
+        loglikelihood += sent_loglikelihood.sum()
+        zero_tokens += int(sent_zero_tokens.sum())
+        found = pos >= 0
+        scatter.add(pos[found], c[found])
+        if theta_jump is not None:
+            # an exact bucket shares one jump matrix, sum over its sentences first
+            weights = c.sum(axis=0) if jumps.shape[0] == 1 else c
+            count_jump += np.bincount(jumps.ravel(), weights=weights.ravel(), minlength=len(theta_jump))
+    return scatter.flush(), count_jump, loglikelihood, zero_tokens
+
+
+def e_step(theta, corpus, theta_jump=None):
+    """
+    Collect the expected counts c(f, e) for every entry of theta.
+
+    :param corpus: a PackedCorpus or a streamed Corpus, encoded with the vocabularies of theta
+    :param theta_jump: jump probabilities for IBM2, None for IBM1
+    :return: counts aligned with theta.data, counts aligned with theta_jump (None for IBM1),
+        the training log-likelihood under theta and theta_jump and the number of french tokens
+        with probability 0 left out of it, see posteriors
+    """
+    count_f_e = np.zeros(theta.nnz)
+    count_jump = None if theta_jump is None else np.zeros(len(theta_jump))
+    loglikelihood = 0.
+    zero_tokens = 0
+    for shard in _shards(corpus):
+        shard_f_e, shard_jump, shard_loglikelihood, shard_zero_tokens = _shard_counts(theta, corpus, shard, theta_jump)
+        count_f_e += shard_f_e
+        if count_jump is not None:
+            count_jump += shard_jump
+        loglikelihood += shard_loglikelihood
+        zero_tokens += shard_zero_tokens
+    return count_f_e, count_jump, loglikelihood, zero_tokens
+
+
+# state of an E-step pool worker, filled in by _init_worker
+_worker = {}
+
+
+def _share(array):
+    """Copy a float array into shared memory, return the raw buffer and an array view of it"""
+    raw = mp.RawArray('f' if array.dtype == np.float32 else 'd', len(array))
+    shared = np.frombuffer(raw, dtype=array.dtype)
+    shared[:] = array
+    return raw, shared
+
+
+def _init_worker(theta, corpus, data_raw, jump_raw):
+    dtype = theta.numerics.dtype
+    theta.data = np.frombuffer(data_raw, dtype=dtype)
+    _worker['theta'] = theta
+    _worker['corpus'] = corpus
+    _worker['theta_jump'] = None if jump_raw is None else np.frombuffer(jump_raw, dtype=dtype)
+
+
+def _worker_counts(shard):
+    count_f_e, count_jump, loglikelihood, zero_tokens = _shard_counts(_worker['theta'], _worker['corpus'], shard,
+                                                                      _worker['theta_jump'])
+    # most entries of theta do not occur in a shard, only send back the ones that do
+    pos = np.flatnonzero(count_f_e)
+    return pos, count_f_e[pos], count_jump, loglikelihood, zero_tokens
+
+
+class ShardedEStep:
+    """
+    Runs the E-step over corpus shards in a process pool.
+
+    A PackedCorpus is split into one shard per worker, a streamed Corpus into its chunks.
+    theta.data and theta_jump are moved into shared memory once, so the workers see the
+    in-place updates of the M-step without the tables being sent every iteration.
+    Use theta_jump of this object afterwards, it is the shared copy.
+    """
+
+    def __init__(self, theta, corpus, theta_jump=None, workers=1):
+        self.theta = theta
+        self.corpus = corpus
+        self.theta_jump = theta_jump
+        self.workers = workers
+        self.pool = None
+        self.jump_raw = None
+        if workers > 1:
+            if theta_jump is not None:
+                self.jump_raw, self.theta_jump = _share(theta_jump)
+            self.shards = _shards(corpus, workers)
+            self.restart()
+
+    def restart(self):
+        """(Re)start the pool with the current theta, needed after its arrays were replaced, e.g. by pruning"""
+        if self.workers > 1:
+            self.close()
+            data_raw, self.theta.data = _share(self.theta.data)
+            self.pool = mp.Pool(self.workers, initializer=_init_worker,
+                                initargs=(self.theta, self.corpus, data_raw, self.jump_raw))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __call__(self):
+        """Collect the expected counts, log-likelihood and zero-probability tokens of the whole corpus, see e_step"""
+        if self.pool is None:
+            return e_step(self.theta, self.corpus, self.theta_jump)
+        count_f_e = np.zeros(self.theta.nnz)
+        count_jump = None if self.theta_jump is None else np.zeros(len(self.theta_jump))
+        loglikelihood = 0.
+        zero_tokens = 0
+        # reduce the partial counts of every shard before the M-step
+        for pos, counts, jump_counts, shard_loglikelihood, shard_zero_tokens in self.pool.imap_unordered(
+                _worker_counts, self.shards):
+            count_f_e[pos] += counts
+            if count_jump is not None:
+                count_jump += jump_counts
+            loglikelihood += shard_loglikelihood
+            zero_tokens += shard_zero_tokens
+        return count_f_e, count_jump, loglikelihood, zero_tokens
+
+
+def m_step(theta, count_f_e):
+    """Re-estimate p(f|e) = c(f, e) / c(e) in place"""
+    count_e = np.bincount(theta.rows, weights=count_f_e, minlength=len(theta))[theta.rows]
+    seen = count_e > 0
+    theta.data[seen] = theta.numerics.encode(count_f_e[seen] / count_e[seen])
+    return theta
+
+
+def m_step_jump(theta_jump, count_jump, numerics):
+    """Re-estimate the jump probabilities in place"""
+    theta_jump[:] = numerics.encode(count_jump / count_jump.sum())
+    return theta_jump
+
+
+def _viterbi_bucket(theta, bucket, theta_jump=None):
+    """Sentence index, french position and english position of every link of a bucket, see viterbi"""
+    numerics = theta.numerics
+    t = theta.get(bucket.e[:, None, :], bucket.f[:, :, None])
+    if theta_jump is not None:
+        # jumps longer than any seen in training get the probability of the longest one
+        jumps = np.minimum(_bucket_jumps(bucket, len(theta_jump) // 2), len(theta_jump) - 1)
+        t = t + theta_jump[np.maximum(jumps, 0)] if numerics.log else t * theta_jump[np.maximum(jumps, 0)]
+    j = np.argmax(t, axis=2)
+    b, i = np.nonzero(bucket.f_mask)
+    return bucket.sents[b], i, j[b, i]
+
+
+def viterbi(theta, corpus, theta_jump=None):
+    """
+    Find the most probable english position for every french token.
+
+    Ties go to the first english position, as in vals.index(max(vals)) of the notebook. Values
+    that tie exactly in Decimal can differ in the last float bits, so the alignments and the AER
+    match the Decimal implementation only up to how such ties are broken.
+
+    :param corpus: a PackedCorpus or a streamed Corpus, encoded with the vocabularies of theta
+    :param theta_jump: jump probabilities to weight the alignments with (IBM2), None to use theta only
+    :return: per bucket, the sentence index, french position and english position of every link
+    """
+    for bucket in _buckets(corpus):
+        yield _viterbi_bucket(theta, bucket, theta_jump)
+
+
+def align(theta, corpus, theta_jump=None):
+    """
+    Viterbi alignments of a corpus as link arrays, one gather and argmax per length bucket.
+
+    :param corpus: a PackedCorpus or a streamed Corpus, encoded with the vocabularies of theta
+    :param theta_jump: jump probabilities to weight the alignments with (IBM2), None to use theta only
+    :return: per shard of the corpus (its chunks when streamed), an (n, 3) int64 array of
+        0-based (sentence, english position, french position) links sorted by sentence and french position
+    """
+    for shard in _shards(corpus):
+        links = [np.stack(_viterbi_bucket(theta, bucket, theta_jump), axis=1)
+                 for bucket in corpus.shard_buckets(shard)]
+        if links:
+            # (sentence, french, english) columns to (sentence, english, french), ordered by sentence and french
+            links = np.concatenate(links)
+            yield links[np.lexsort((links[:, 1], links[:, 0]))][:, [0, 2, 1]]
+
+
+# neighbours of a link considered by grow-diag, as (english, french) offsets
+_NEIGHBOURS = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+def _in_sorted(keys, sorted_keys):
+    """Mask of the keys that occur in sorted_keys, by binary search (faster than np.isin for link keys)"""
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+    return sorted_keys[np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)] == keys
+
+
+def _grow_diag(ef, fe, M, final):
+    """
+    grow-diag(-final) of sorted unique link keys (s * M + e) * M + f, following Koehn et al.
+
+    Koehn's grow-diag scans the (english, french) grid of every sentence in order, adding neighbouring
+    union links of a word that is still unaligned one at a time, and rescans until nothing is added.
+    A link that has been scanned can never add anything later: the union is fixed and aligned words
+    stay aligned. So every link is visited once, in a heap ordered like the scan, and a link added
+    behind the scan position waits for the next pass. Only intersection links next to a union link
+    outside the intersection, found with numpy, start in the heap; sentences without such links
+    keep their intersection untouched. The Python work is a few set operations per link of the
+    union outside the intersection and per intersection link next to one.
+    """
+    in_fe = _in_sorted(ef, fe)
+    alignment = ef[in_fe]
+    candidates = np.sort(np.concatenate([ef[~in_fe], fe[~_in_sorted(fe, ef)]]))
+    s, e, f = alignment // (M * M), alignment // M % M, alignment % M
+    near = np.zeros(len(alignment), dtype=bool)
+    for de, df in _NEIGHBOURS:
+        inside = (e + de >= 0) & (e + de < M) & (f + df >= 0) & (f + df < M)
+        near |= inside & _in_sorted(alignment + de * M + df, candidates)
+
+    aligned = set(alignment.tolist())
+    aligned_e = set((s * M + e).tolist())
+    aligned_f = set((s * M + f).tolist())
+    union = set(candidates.tolist())
+
+    def add(key):
+        aligned.add(key)
+        aligned_e.add(key // M)
+        aligned_f.add(key // (M * M) * M + key % M)
+
+    def unaligned(key):
+        return key // M not in aligned_e or key // (M * M) * M + key % M not in aligned_f
+
+    todo = alignment[near].tolist()
+    while todo:
+        heapq.heapify(todo)
+        later = []
+        while todo:
+            key = heapq.heappop(todo)
+            e, f = key // M % M, key % M
+            for de, df in _NEIGHBOURS:
+                link = key + de * M + df
+                if 0 <= e + de < M and 0 <= f + df < M and link in union and link not in aligned \
+                        and unaligned(link):
+                    add(link)
+                    # the scan reaches links after the current one in this pass, the others in the next
+                    if link > key:
+                        heapq.heappush(todo, link)
+                    else:
+                        later.append(link)
+        todo = later
+    if final:
+        for links in (ef, fe):
+            for key in links[_in_sorted(links, candidates)].tolist():
+                if key not in aligned and unaligned(key):
+                    add(key)
+    return np.array(sorted(aligned), dtype=np.int64)
+
+
+def symmetrize(links_ef, links_fe, heuristic='grow-diag-final'):
+    """
+    Combine the Viterbi links of the two translation directions.
+
+    grow-diag starts from the intersection and adds the union links neighbouring the alignment
+    whose english or french word is still unaligned, one at a time until none can be added.
+    grow-diag-final then adds the remaining links of unaligned words of each direction.
+    Intersection and union are single numpy set operations on link keys, the growing heuristics
+    cost a Python step per union link outside the intersection, see _grow_diag.
+    :param links_ef: (sentence, english, french) links of the english to french model
+    :param links_fe: the links of the french to english model, in the same (sentence, english, french) order
+    :param heuristic: 'intersection', 'union', 'grow-diag' or 'grow-diag-final'
+    :return: the symmetrized (n, 3) link array, sorted by sentence, english and french position
+    """
+    if heuristic not in ('intersection', 'union', 'grow-diag', 'grow-diag-final'):
+        raise ValueError('Unknown symmetrization heuristic %r' % heuristic)
+    M = int(max(links_ef[:, 1:].max(initial=0), links_fe[:, 1:].max(initial=0))) + 1
+
+    def encode(s, e, f):
+        return (s * M + e) * M + f
+
+    ef, fe = (np.sort(encode(*links.T.astype(np.int64))) for links in (links_ef, links_fe))
+    # Viterbi links are unique, but the two arrays are used as sets
+    ef, fe = (keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys for keys in (ef, fe))
+    if heuristic == 'union':
+        alignment = np.sort(np.concatenate([ef, fe[~_in_sorted(fe, ef)]]))
+    elif heuristic == 'intersection':
+        alignment = ef[_in_sorted(ef, fe)]
+    else:
+        alignment = _grow_diag(ef, fe, M, heuristic == 'grow-diag-final')
+    return np.stack([alignment // (M * M), alignment // M % M, alignment % M], axis=1)
+
+
+def write_naacl(alignments, filename):
+    """
+    Write link arrays from align to filename.naacl as they come, with 1-based positions.
+
+    :return: the number of links written
+    """
+    n = 0
+    with open('{}.naacl'.format(filename), 'w') as file:
+        for links in alignments:
+            np.savetxt(file, links + 1, fmt='%d %d %d S')
+            n += len(links)
+    return n
+
+
+def _loglikelihood(theta, corpus):
+    loglikelihood_total = 0
+    for bucket in _buckets(corpus):
+        # find the english word that maximizes p(f|e) for every french word
+        max_p_fe = theta.numerics.decode(theta.get(bucket.e[:, None, :], bucket.f[:, :, None]).max(axis=2))
+        log_max = np.log(np.where(bucket.f_mask, max_p_fe, 1.)).sum(axis=1)
+        le, lf = bucket.le, bucket.lf
+        loglikelihood_total += (np.log(lf / le) + lf * np.log(1 / le) + log_max).sum()
+    return loglikelihood_total
+
+
+def get_loglikelihood(en_train, fr_train, theta):
+    """Training log-likelihood, using the most probable english word for every french word"""
+    return _loglikelihood(theta, theta.encode(en_train, fr_train))
+
+
+def _aer(theta, corpus, sure, probable, n_sents):
+    """
+    AER of the Viterbi alignments of an encoded corpus against gold link keys, see aer.gold_link_keys.
+
+    :param n_sents: number of sentences with gold alignments, links of later sentences are ignored
+    :return: AER and the (sentence, english, french) links of the sentences that have gold alignments
+    """
+    links = np.concatenate([np.zeros((0, 3), dtype=np.int64)] + list(align(theta, corpus)))
+    links = links[links[:, 0] < n_sents]
+    metric = aer.LinkAERSufficientStatistics()
+    metric.update(sure=sure, probable=probable, predicted=aer.link_keys(links[:, 0], links[:, 1] + 1, links[:, 2] + 1))
+    return metric.aer(), links
+
+
+def _gold_links(path, sents):
+    """
+    Gold link keys of the given sentences of a NAACL file, see aer.read_naacl_links.
+
+    :param sents: sorted indices of the sentences, those without gold alignments are dropped
+    :return: sure and possible keys with the sentences renumbered 0, 1, ... in the order of sents,
+        and the number of sentences kept
+    """
+    sure, probable, n_sents = aer.read_naacl_links(path)
+    sents = sents[sents < n_sents]
+    position_mask = (1 << 2 * aer.POSITION_BITS) - 1
+
+    def select(keys):
+        s = keys >> 2 * aer.POSITION_BITS
+        keep = np.isin(s, sents)
+        return (np.searchsorted(sents, s[keep]) << 2 * aer.POSITION_BITS) | (keys[keep] & position_mask)
+
+    return select(sure), select(probable), len(sents)
+
+
+def compute_aer(en_data, fr_data, path, theta):
+    """
+    Compute the AER of the Viterbi alignments of the given data.
+
+    :return: AER and a list with the set of predicted (english, french) links of every sentence
+    """
+    sure, probable, n_sents = _gold_links(path, np.arange(len(en_data)))
+    aer_value, links = _aer(theta, theta.encode(en_data, fr_data), sure, probable, n_sents)
+    predictions = [set() for _ in range(n_sents)]
+    for s, e_pos, f_pos in links.tolist():
+        predictions[s].add((e_pos + 1, f_pos + 1))
+    return aer_value, predictions
+
+
+class Monitor:
+    """
+    When and on what the training curve is tracked.
+
+    The training log-likelihood is a by-product of the E-step and costs nothing extra, it is the
+    log-likelihood of the parameters an iteration starts from. Validation AER needs a Viterbi pass,
+    so it is computed every `every` iterations and after the last one, on a fixed random sample
+    of `sample` validation sentences (all of them when None).
+    The time, table size, table memory and the number of training tokens with probability 0
+    (left out of the log-likelihood, see posteriors) of every iteration are kept in history.
+    """
+
+    def __init__(self, every=1, sample=None, seed=0):
+        self.every = every
+        self.sample = sample
+        self.seed = seed
+        self.history = []
+
+    def record(self, k, seconds, size, theta, zero_tokens=0):
+        """Keep the statistics of iteration k, size is the (entries, bytes) of theta before pruning"""
+        self.history.append({'iteration': k + 1, 'seconds': seconds, 'entries_before': size[0],
+                             'bytes_before': size[1], 'entries': theta.nnz, 'bytes': theta.nbytes,
+                             'zero_tokens': zero_tokens})
+
+    def report(self):
+        """Print the statistics of the last iteration"""
+        stats = self.history[-1]
+        print('Iteration time: {:.2f}s'.format(stats['seconds']))
+        print('Table size: {} -> {} entries, {:.1f} -> {:.1f} MB'.format(
+            stats['entries_before'], stats['entries'], stats['bytes_before'] / 2 ** 20, stats['bytes'] / 2 ** 20))
+        if stats['zero_tokens']:
+            print('Training tokens with probability 0: {}'.format(stats['zero_tokens']))
+
+    def due(self, k, K):
+        """Whether iteration k (counted from 0) of K is recorded"""
+        return (k + 1) % self.every == 0 or k == K - 1
+
+    def validation(self, theta, en_val, fr_val, path):
+        """Encode the (sampled) validation data once, return a function of theta giving its AER"""
+        sents = np.arange(len(en_val))
+        if self.sample is not None and self.sample < len(en_val):
+            sents = np.sort(np.random.RandomState(self.seed).choice(len(en_val), self.sample, replace=False))
+        corpus = theta.encode([en_val[n] for n in sents], [fr_val[n] for n in sents])
+        sure, probable, n_sents = _gold_links(path, sents)
+        return lambda theta: _aer(theta, corpus, sure, probable, n_sents)[0]
+
+
+def export_naacl(predictions, filename):
+    if isinstance(predictions, np.ndarray):
+        # (sentence, english, french) link array, e.g. from symmetrize
+        write_naacl([predictions], filename)
+        return
+    with open('{}.naacl'.format(filename), 'w') as file:
+        for index, sen in enumerate(predictions):
+            for align in sen:
+                file.write('{} {} {} S\n'.format(index + 1, align[0], align[1]))
+
+
+def train_EM(en_train, fr_train, theta, en_val, fr_val, en_test, fr_test, path, K, workers=1, corpus=None,
+             numerics=None, monitor=None, floor=None, top_k=None):
+    """
+    Train IBM1 with K iterations of EM, reporting validation AER and training log-likelihood.
+
+    The log-likelihood comes from the E-step of each iteration, so it is that of the parameters
+    the iteration starts from and the training data is scanned once per iteration.
+
+    :param workers: number of processes the E-step is sharded over
+    :param corpus: the training data as a PackedCorpus (e.g. from corpus.pack_files) or as a Corpus
+        streamed in chunks (e.g. memory-mapped with Corpus.open), en_train and fr_train are not used when it is given
+    :param numerics: 'float32', 'float64' or 'log-float64', theta is converted to it before training
+    :param monitor: a Monitor, by default everything is recorded every iteration
+    :param floor: after every M-step, prune entries of theta below this probability, see TranslationTable.prune
+    :param top_k: after every M-step, keep only the top_k french words of every english word
+    :return: trained theta, validation AER, training log-likelihood and the recorded iteration numbers
+    """
+    if corpus is None:
+        corpus = theta.encode(en_train, fr_train)
+    if numerics is not None:
+        theta.set_numerics(numerics)
+    monitor = Monitor() if monitor is None else monitor
+    validation_aer = monitor.validation(theta, en_val, fr_val, path)
+    AER = []
+    iteration = []
+    t_log = []
+    with ShardedEStep(theta, corpus, workers=workers) as expected_counts:
+        for k in range(K):
+            start = time.perf_counter()
+            count_f_e, _, log_likelihood, zero_tokens = expected_counts()
+            m_step(theta, count_f_e)
+            size = theta.nnz, theta.nbytes
+            if (floor is not None or top_k is not None) and theta.prune(floor, top_k):
+                expected_counts.restart()
+            monitor.record(k, time.perf_counter() - start, size, theta, zero_tokens)
+            if not monitor.due(k, K):
+                continue
+            iteration.append(k + 1)
+            print('Iteration {}:'.format(k))
+            monitor.report()
+            # compute AER on the validation set
+            aer = validation_aer(theta)
+            print('Validation AER:', aer)
+            AER.append(aer)
+
+            t_log.append(log_likelihood)
+            print("Training log-likelihood:", log_likelihood)
+    return theta, AER, t_log, iteration
+
+
+def init_random(theta, seed):
+    """Replace theta in place with random probabilities, normalized per english word"""
+    rng = np.random.RandomState(seed)
+    p = rng.random_sample(theta.nnz)
+    count_e = np.bincount(theta.rows, weights=p, minlength=len(theta))
+    theta.data[:] = theta.numerics.encode(p / count_e[theta.rows])
+    return theta
+
+
+def theta_jump_init(corpus, theta_jump=None, seed=None, numerics=None):
+    """
+    Initialize the jump probabilities as a dense array over jumps -k, ..., k.
+
+    Jump x is stored at index x + k, where k is the length of the longest sentence of the corpus.
+    :param theta_jump: None for a uniform initialization, anything else for a random one
+    :param numerics: Numerics of the returned array, float64 by default
+    :return: the jump probabilities and k
+    """
+    max_jump_value = int(corpus.max_length)
+    if theta_jump is None:
+        theta_jump = np.full(max_jump_value * 2 + 1, 1 / (max_jump_value * 2 + 1))
+    else:
+        random.seed(seed)
+        theta_jump = np.array([random.random() for _ in range(max_jump_value * 2 + 1)])
+        theta_jump /= theta_jump.sum()
+    numerics = Numerics() if numerics is None else numerics
+    return numerics.encode(theta_jump), max_jump_value
+
+
+def train_EM_ibm2(en_train, fr_train, theta, en_val, fr_val, en_test, fr_test, path, K,
+                  theta_jump=None, seed=None, workers=1, corpus=None, numerics=None, monitor=None,
+                  floor=None, top_k=None):
+    """
+    Train IBM2 with K iterations of EM, reporting validation AER and training log-likelihood.
+
+    The log-likelihood comes from the E-step, as in train_EM.
+
+    :param theta_jump: None for uniform jump probabilities, 'random' for random ones drawn with seed
+    :param workers: number of processes the E-step is sharded over
+    :param corpus: the training data as a PackedCorpus (e.g. from corpus.pack_files) or as a Corpus
+        streamed in chunks (e.g. memory-mapped with Corpus.open), en_train and fr_train are not used when it is given
+    :param numerics: 'float32', 'float64' or 'log-float64', theta is converted to it before training
+    :param monitor: a Monitor, by default everything is recorded every iteration
+    :param floor: after every M-step, prune entries of theta below this probability, see TranslationTable.prune
+    :param top_k: after every M-step, keep only the top_k french words of every english word
+    :return: trained theta, validation AER, training log-likelihood, the recorded iteration numbers
+        and the trained jump probabilities (stored like theta)
+    """
+    if corpus is None:
+        corpus = theta.encode(en_train, fr_train)
+    if numerics is not None:
+        theta.set_numerics(numerics)
+    monitor = Monitor() if monitor is None else monitor
+    validation_aer = monitor.validation(theta, en_val, fr_val, path)
+    AER = []
+    iteration = []
+    t_log = []
+    theta_jump, _ = theta_jump_init(corpus, theta_jump, seed, theta.numerics)
+    with ShardedEStep(theta, corpus, theta_jump, workers=workers) as expected_counts:
+        theta_jump = expected_counts.theta_jump
+        for k in range(K):
+            start = time.perf_counter()
+            count_f_e, count_jump, log_likelihood, zero_tokens = expected_counts()
+            # M step for p(f|e) and p(a)
+            m_step(theta, count_f_e)
+            m_step_jump(theta_jump, count_jump, theta.numerics)
+            size = theta.nnz, theta.nbytes
+            if (floor is not None or top_k is not None) and theta.prune(floor, top_k):
+                expected_counts.restart()
+            monitor.record(k, time.perf_counter() - start, size, theta, zero_tokens)
+            if not monitor.due(k, K):
+                continue
+            iteration.append(k + 1)
+            print('Iteration {}:'.format(k))
+            monitor.report()
+            # compute AER on the validation set
+            aer = validation_aer(theta)
+            print('Validation AER:', aer)
+            AER.append(aer)
+
+            t_log.append(log_likelihood)
+            print("Training log-likelihood:", log_likelihood)
+    return theta, AER, t_log, iteration, theta_jump
+
+
+def save_model(path, theta, theta_jump=None):
+    """
+    Save trained parameters to a directory of flat arrays, see load_model.
+
+    The vocabularies are sorted string tables with one word per line, theta is stored as its
+    CSR arrays (and the sorted pair keys used for lookups), the jump probabilities as a dense array.
+    Probabilities are stored as described by theta.numerics.
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, vocab in (('en_vocab', theta.en_vocab), ('fr_vocab', theta.fr_vocab)):
+        with open(os.path.join(path, name + '.txt'), mode='w', encoding='utf-8') as file:
+            file.write('\n'.join(vocab.i2w))
+    for name in ('indptr', 'indices', 'data', 'keys'):
+        np.save(os.path.join(path, name + '.npy'), getattr(theta, name))
+    if theta_jump is not None:
+        np.save(os.path.join(path, 'jump.npy'), theta_jump)
+    with open(os.path.join(path, 'model.json'), 'w') as file:
+        json.dump({'numerics': theta.numerics.name, 'ibm2': theta_jump is not None}, file)
+
+
+def load_model(path, mmap_mode='r'):
+    """
+    Load parameters written by save_model.
+
+    :param mmap_mode: np.load mode of the arrays, with the default 'r' they are memory-mapped read-only,
+        so loading is immediate and processes aligning with the same model share one copy of it.
+        Use 'c' or None for parameters that are trained further.
+    :return: theta, and the jump probabilities (None for IBM1)
+    """
+    with open(os.path.join(path, 'model.json')) as file:
+        header = json.load(file)
+    vocabs = []
+    for name in ('en_vocab', 'fr_vocab'):
+        with open(os.path.join(path, name + '.txt'), mode='r', encoding='utf-8') as file:
+            vocabs.append(Vocabulary(file.read().split('\n')))
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+              for name in ('indptr', 'indices', 'data', 'keys')}
+    theta = TranslationTable(*vocabs, numerics=Numerics(header['numerics']), **arrays)
+    theta_jump = None
+    if header['ibm2']:
+        theta_jump = np.load(os.path.join(path, 'jump.npy'), mmap_mode=mmap_mode)
+    return theta, theta_jump
+
+
+class OnlineEM:
+    """
+    Stepwise EM (Liang and Klein, 2009) over mini-batches of new sentence pairs.
+
+    The sufficient statistics count_f_e (aligned with theta.data), count_e and count_jump persist
+    between batches. Update t interpolates them with the expected counts of a batch,
+    s = (1 - eta) * s + eta * s_batch with eta = (t + 2) ** -alpha, and re-normalizes theta,
+    so new data is folded in without revisiting the old. alpha in (0.5, 1], smaller forgets faster.
+    Words and pairs that were not seen before are added to theta (see TranslationTable.grow),
+    and the jump table is widened for longer sentences.
+
+    Example usage:
+        online = OnlineEM.load('model')
+        online.train(en_new, fr_new, batch_size=10000)
+        online.save('model')
+    """
+
+    def __init__(self, theta, theta_jump=None, count_f_e=None, count_e=None, count_jump=None, step=0, alpha=0.7):
+        """
+        :param theta: initial translation table, e.g. from init_theta or load_model
+        :param theta_jump: jump probabilities for IBM2, None for IBM1
+        :param count_f_e: statistics to resume from, by default those of theta itself
+            (one expected occurrence per english word), use step to say how much to trust them
+        """
+        self.theta = theta
+        self.theta_jump = theta_jump
+        self.count_f_e = theta.numerics.decode(theta.data) if count_f_e is None else count_f_e
+        self.count_e = np.bincount(theta.rows, weights=self.count_f_e, minlength=len(theta)) \
+            if count_e is None else count_e
+        if theta_jump is not None and count_jump is None:
+            count_jump = theta.numerics.decode(theta_jump)
+        self.count_jump = count_jump
+        self.step = step
+        self.alpha = alpha
+
+    def _grow(self, en_sents, fr_sents):
+        """Add the new words and pairs of a batch to theta and the statistics"""
+        en_map, old_pos = self.theta.grow(en_sents, fr_sents)
+        if len(old_pos) != self.theta.nnz or len(self.count_e) != len(self.theta):
+            count_f_e = np.zeros(self.theta.nnz)
+            count_f_e[old_pos] = self.count_f_e
+            count_e = np.zeros(len(self.theta))
+            count_e[en_map] = self.count_e
+            self.count_f_e, self.count_e = count_f_e, count_e
+        if self.theta_jump is not None:
+            k = len(self.theta_jump) // 2
+            max_jump_value = max([k] + [max(len(e), len(f)) for e, f in zip(en_sents, fr_sents)])
+            if max_jump_value > k:
+                # unseen jumps start at the probability of the least probable one
+                numerics = self.theta.numerics
+                p = np.pad(numerics.decode(self.theta_jump), max_jump_value - k, mode='constant',
+                           constant_values=numerics.decode(self.theta_jump).min())
+                self.theta_jump = numerics.encode(p / p.sum())
+                self.count_jump = np.pad(self.count_jump, max_jump_value - k, mode='constant')
+
+    def update(self, en_sents, fr_sents):
+        """
+        One stepwise EM update with a mini-batch of tokenized sentence pairs (english with the NULL token).
+
+        :return: log-likelihood of the batch before the update, see posteriors
+        """
+        self._grow(en_sents, fr_sents)
+        count_f_e, count_jump, loglikelihood, _ = e_step(self.theta, self.theta.encode(en_sents, fr_sents),
+                                                         self.theta_jump)
+        eta = (self.step + 2) ** -self.alpha
+        self.count_f_e = (1 - eta) * self.count_f_e + eta * count_f_e
+        self.count_e = (1 - eta) * self.count_e + eta * np.bincount(self.theta.rows, weights=count_f_e,
+                                                                    minlength=len(self.theta))
+        seen = self.count_e[self.theta.rows] > 0
+        self.theta.data[seen] = self.theta.numerics.encode(
+            self.count_f_e[seen] / self.count_e[self.theta.rows[seen]])
+        if self.theta_jump is not None:
+            self.count_jump = (1 - eta) * self.count_jump + eta * count_jump
+            m_step_jump(self.theta_jump, self.count_jump, self.theta.numerics)
+        self.step += 1
+        return loglikelihood
+
+    def train(self, en_sents, fr_sents, batch_size=10000, epochs=1):
+        """
+        Update with consecutive mini-batches of the given sentence pairs.
+
+        :return: the log-likelihood of every batch
+        """
+        t_log = []
+        for epoch in range(epochs):
+            for start in range(0, len(en_sents), batch_size):
+                t_log.append(self.update(en_sents[start:start + batch_size], fr_sents[start:start + batch_size]))
+        return t_log
+
+    def save(self, path):
+        """Save theta and the jump table with save_model, and the statistics next to them"""
+        save_model(path, self.theta, self.theta_jump)
+        np.save(os.path.join(path, 'count_f_e.npy'), self.count_f_e)
+        np.save(os.path.join(path, 'count_e.npy'), self.count_e)
+        if self.count_jump is not None:
+            np.save(os.path.join(path, 'count_jump.npy'), self.count_jump)
+        with open(os.path.join(path, 'online.json'), 'w') as file:
+            json.dump({'step': self.step, 'alpha': self.alpha}, file)
+
+    @classmethod
+    def load(cls, path, step=None, alpha=None):
+        """
+        Resume from a directory written by save, or start from a model written by save_model.
+
+        :param step: override the number of updates done, e.g. to down-weight the first batches
+            after a model trained in batch mode
+        """
+        theta, theta_jump = load_model(path, mmap_mode=None)
+        state = {'step': 0, 'alpha': 0.7}
+        counts = {}
+        if os.path.exists(os.path.join(path, 'online.json')):
+            with open(os.path.join(path, 'online.json')) as file:
+                state = json.load(file)
+            for name in ('count_f_e', 'count_e', 'count_jump'):
+                if os.path.exists(os.path.join(path, name + '.npy')):
+                    counts[name] = np.load(os.path.join(path, name + '.npy'))
+        return cls(theta, theta_jump, step=state['step'] if step is None else step,
+                   alpha=state['alpha'] if alpha is None else alpha, **counts)
+
+
+def _reverse_naacl(path, filename):
+    """Write the gold alignments of path with english and french positions swapped"""
+    with open(filename, 'w') as file:
+        for n, (sure, probable) in enumerate(read_naacl_alignments(path)):
+            for x, y in sorted(probable):
+                file.write('{} {} {} {}\n'.format(n + 1, y, x, 'S' if (x, y) in sure else 'P'))
+
+
+def _train_direction(conn, ibm2, args, kwargs):
+    """Train one direction in a child process and send the result back"""
+    train = train_EM_ibm2 if ibm2 else train_EM
+    conn.send(train(*args, **kwargs))
+    conn.close()
+
+
+def train_bidirectional(en_train, fr_train, en_val, fr_val, en_test, fr_test, path, K, filename,
+                        ibm2=False, heuristic='grow-diag-final', **kwargs):
+    """
+    Train english to french and french to english models concurrently and symmetrize their alignments.
+
+    Both corpora are packed before two processes are forked, so the children read them without a copy.
+    Each child runs train_EM (or train_EM_ibm2) with its own E-step workers, the french to english
+    model is validated against the gold alignments with the positions swapped.
+    The Viterbi links of the test data in both directions are symmetrized and written with export_naacl.
+    :param en_train: tokenized english sentences with the NULL token, as for train_EM
+    :param filename: the symmetrized test alignments are written to filename.naacl
+    :param heuristic: see symmetrize
+    :param kwargs: passed on to train_EM or train_EM_ibm2 (workers, numerics, monitor, ...)
+    :return: the results of train_EM (or train_EM_ibm2) in both directions, and the symmetrized test links
+    """
+    en_plain = [s[1:] if s and s[0] == NULL else s for s in en_train]
+    fr_null = [[NULL] + s for s in fr_train]
+    theta_ef = init_theta(en_train, fr_train)
+    theta_fe = init_theta(fr_null, en_plain)
+    corpus_ef = theta_ef.encode(en_train, fr_train)
+    corpus_fe = theta_fe.encode(fr_null, en_plain)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path_fe = os.path.join(tmp, 'gold_fe.naacl')
+        _reverse_naacl(path, path_fe)
+        jobs = [((None, None, theta_ef, en_val, fr_val, en_test, fr_test, path, K), corpus_ef),
+                ((None, None, theta_fe, fr_val, en_val, fr_test, en_test, path_fe, K), corpus_fe)]
+        # fork the children before either result is received so both directions run at the same time
+        processes, connections = [], []
+        for args, corpus in jobs:
+            receiver, sender = mp.Pipe(duplex=False)
+            process = mp.Process(target=_train_direction, args=(sender, ibm2, args, dict(kwargs, corpus=corpus)))
+            process.start()
+            sender.close()
+            processes.append(process)
+            connections.append(receiver)
+        results = [receiver.recv() for receiver in connections]
+        for process in processes:
+            process.join()
+
+    (theta_ef, *_), (theta_fe, *_) = results
+    jump_ef, jump_fe = (result[4] for result in results) if ibm2 else (None, None)
+    links_ef = np.concatenate(list(align(theta_ef, theta_ef.encode(en_test, fr_test), jump_ef)))
+    links_fe = np.concatenate(list(align(theta_fe, theta_fe.encode(fr_test, en_test), jump_fe)))
+    links = symmetrize(links_ef, links_fe[:, [0, 2, 1]], heuristic)
+    export_naacl(links, filename)
+    return results[0], results[1], links
+
+
+def _train_decimal(en_train, fr_train, K):
+    """Reference IBM1 EM with Decimal probabilities in nested dicts, as originally in the notebook"""
+    from collections import defaultdict
+    from decimal import Decimal
+    theta = defaultdict(lambda: defaultdict(lambda: Decimal(0)))
+    for en_n, fr_n in zip(en_train, fr_train):
+        for en in en_n:
+            for fr in fr_n:
+                theta[en][fr] = 0
+    for en in theta:
+        for fr in theta[en]:
+            theta[en][fr] = Decimal(1 / len(theta[en]))
+    for k in range(K):
+        count_f_e = defaultdict(lambda: Decimal(0))
+        count_e = defaultdict(lambda: Decimal(0))
+        for en_n, fr_n in zip(en_train, fr_train):
+            for fr in fr_n:
+                Z = sum(theta[en][fr] for en in en_n)
+                for en in en_n:
+                    c = theta[en][fr] / Z
+                    count_f_e[(fr, en)] += c
+                    count_e[en] += c
+        for (f, e) in count_f_e:
+            theta[e][f] = count_f_e[(f, e)] / count_e[e]
+    return theta
+
+
+def test(en_path, fr_path, path, K=5, tolerance=0.01):
+    """
+    Check that every numerics gets within tolerance of the validation AER of the Decimal implementation.
+
+    The AERs are not identical, exact ties of the Decimal probabilities break differently in floats
+    (see viterbi). On dev they differ by 0.005 after 1 iteration and 0.002 after 5, the test_ibm
+    tests check the alignments link by link.
+
+    :return: True when every numerics is within tolerance
+    """
+    from corpus import read_sentences
+    en_train, fr_train = read_sentences(en_path, null=True), read_sentences(fr_path)
+    en_val, fr_val = read_sentences(en_path), read_sentences(fr_path)
+
+    # Viterbi alignments of the Decimal reference, first maximum wins
+    theta = _train_decimal(en_train, fr_train, K)
+    metric = aer.AERSufficientStatistics()
+    for gold, en_n, fr_n in zip(read_naacl_alignments(path), en_val, fr_val):
+        pred = set()
+        for i, fr in enumerate(fr_n):
+            vals = [theta[en][fr] for en in en_n]
+            pred.add((vals.index(max(vals)) + 1, i + 1))
+        metric.update(sure=gold[0], probable=gold[1], predicted=pred)
+    print('Decimal validation AER:', metric.aer())
+
+    ok = True
+    for name in Numerics.NAMES:
+        theta = init_theta(en_train, fr_train).set_numerics(name)
+        corpus = theta.encode(en_train, fr_train)
+        for k in range(K):
+            m_step(theta, e_step(theta, corpus)[0])
+        aer_value, _ = compute_aer(en_val, fr_val, path, theta)
+        close = abs(aer_value - metric.aer()) <= tolerance
+        ok &= close
+        print('{} validation AER: {} ({})'.format(name, aer_value, 'ok' if close else 'MISMATCH'))
+    return ok
+
+
+if __name__ == '__main__':
+    if not test('validation/dev.e', 'validation/dev.f', 'validation/dev.wa.nonullalign'):
+        raise SystemExit(1)
@@ -0,0 +1,78 @@
+"""
+Tests of the AER metrics and alignment readers, run with python -m pytest from week1.
+"""
+import numpy as np
+import aer
+
+
+def read_both(path):
+    """Keys of read_naacl_links and of read_naacl_alignments, which must agree"""
+    sure, probable, n_sents = aer.read_naacl_links(str(path))
+    gold = aer.read_naacl_alignments(str(path))
+    expected = aer.gold_link_keys(gold)
+    assert n_sents == len(gold)
+    assert sure.tolist() == expected[0].tolist() and probable.tolist() == expected[1].tolist()
+    return sure, probable, n_sents
+
+
+def test_read_naacl_links_blank_file(tmp_path):
+    for text in ('\n', '\n\n', ''):
+        path = tmp_path / 'blank.wa'
+        path.write_text(text)
+        sure, probable, n_sents = read_both(path)
+        assert (len(sure), len(probable), n_sents) == (0, 0, 0)
+
+
+def test_read_naacl_links_blank_chunk(tmp_path, monkeypatch):
+    # the second chunk of 8 bytes holds nothing but blank lines
+    monkeypatch.setattr(aer, 'CHUNK_BYTES', 8)
+    path = tmp_path / 'gaps.wa'
+    path.write_text('1 1 1\n' + '\n' * 12 + '2 2 2 P\n3 1 2 S\n')
+    sure, probable, n_sents = read_both(path)
+    assert (len(sure), len(probable), n_sents) == (2, 3, 3)
+
+
+def random_links(rng, n_sents, n_links):
+    return aer.link_keys(rng.randint(0, n_sents, n_links), rng.randint(1, 20, n_links), rng.randint(1, 20, n_links))
+
+
+def test_sentence_statistics_merge_shards():
+    rng = np.random.RandomState(0)
+    probable = np.unique(random_links(rng, 40, 600))
+    sure = probable[rng.rand(len(probable)) < 0.6]
+    predicted = random_links(rng, 40, 500)
+    lengths = rng.randint(1, 60, 40)
+    full = aer.SentenceAERSufficientStatistics()
+    full.update(sure, probable, predicted, lengths=lengths)
+
+    # every shard gets the gold links and lengths of its own sentences only
+    shards = []
+    for part in (np.arange(0, 15), np.arange(15, 32), np.arange(32, 40)):
+        def own(keys):
+            return keys[np.isin(keys >> 2 * aer.POSITION_BITS, part)]
+        stats = aer.SentenceAERSufficientStatistics()
+        stats.update(own(sure), own(probable), own(predicted), sentences=part, lengths=lengths[part])
+        shards.append(stats)
+    for merged in (shards[0].merge(shards[1]).merge(shards[2]), shards[2].merge(shards[0].merge(shards[1]))):
+        assert len(merged) == len(full) == 40
+        assert merged.aer() == full.aer()
+        np.testing.assert_array_equal(merged.counts[:, :40], full.counts[:, :40])
+        np.testing.assert_array_equal(merged.lengths[:40], full.lengths[:40])
+        assert merged.report() == full.report()
+
+    plain = aer.LinkAERSufficientStatistics()
+    plain.update(sure, probable, predicted)
+    assert full.aer() == plain.aer()
+
+
+def test_sentence_statistics_report():
+    stats = aer.SentenceAERSufficientStatistics()
+    assert stats.report().splitlines()[1:] == ['     all      0       -         -       -',
+                                               'sure: - possible: - wrong: -']
+    keys = aer.link_keys([0, 1, 2], [1, 1, 1], [1, 2, 1])
+    stats.update(keys, keys, keys[:2], lengths=[5, 12, 12])
+    assert stats.report().splitlines() == ['  length  sents     AER precision  recall',
+                                           '     0-9      1  0.0000    1.0000  1.0000',
+                                           '   10-19      2  0.3333    1.0000  0.5000',
+                                           '     all      3  0.2000    1.0000  0.6667',
+                                           'sure: 0.6667 possible: - wrong: 0.0000']
@@ -0,0 +1,127 @@
+"""
+Tests of the alignment engine, run with python -m pytest from week1.
+"""
+import os
+import numpy as np
+import pytest
+import ibm
+from corpus import read_sentences
+
+DEV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'validation', 'dev')
+
+
+def links(pairs, sentence=0):
+    return np.array([(sentence, e, f) for e, f in pairs], dtype=np.int64).reshape(-1, 3)
+
+
+def test_symmetrize_adds_links_one_at_a_time():
+    # (1, 1) is added next to (0, 0) first, after which both words of the
+    # neighbouring union link (1, 2) are aligned, so grow-diag must skip it
+    ef = links([(0, 0), (2, 2), (1, 1)])
+    fe = links([(0, 0), (2, 2), (1, 2)])
+    assert ibm.symmetrize(ef, fe, 'intersection')[:, 1:].tolist() == [[0, 0], [2, 2]]
+    assert ibm.symmetrize(ef, fe, 'union')[:, 1:].tolist() == [[0, 0], [1, 1], [1, 2], [2, 2]]
+    assert ibm.symmetrize(ef, fe, 'grow-diag')[:, 1:].tolist() == [[0, 0], [1, 1], [2, 2]]
+    assert ibm.symmetrize(ef, fe, 'grow-diag-final')[:, 1:].tolist() == [[0, 0], [1, 1], [2, 2]]
+
+
+def test_symmetrize_final_adds_unaligned_words():
+    # (2, 1) and (1, 2) grow from (1, 1), (3, 3) is not a neighbour and only comes in the final step
+    ef = links([(0, 0), (1, 1), (2, 1)], sentence=4)
+    fe = links([(0, 0), (1, 1), (1, 2), (3, 3)], sentence=4)
+    assert ibm.symmetrize(ef, fe, 'grow-diag').tolist() == [[4, 0, 0], [4, 1, 1], [4, 1, 2], [4, 2, 1]]
+    assert ibm.symmetrize(ef, fe, 'grow-diag-final').tolist() == [[4, 0, 0], [4, 1, 1], [4, 1, 2], [4, 2, 1],
+                                                                  [4, 3, 3]]
+
+
+def grow_diag_final(ef, fe, final):
+    """Koehn's grow-diag(-final) of one sentence as written, rescanning the whole grid"""
+    alignment, union = ef & fe, ef | fe
+    size = max(max(link) for link in union) + 1 if union else 0
+
+    def unaligned(e, f):
+        return all(e != a for a, _ in alignment) or all(f != b for _, b in alignment)
+
+    added = True
+    while added:
+        added = False
+        for e in range(size):
+            for f in range(size):
+                if (e, f) in alignment:
+                    for de, df in ibm._NEIGHBOURS:
+                        link = (e + de, f + df)
+                        if link in union and link not in alignment and unaligned(*link):
+                            alignment.add(link)
+                            added = True
+    for links in (ef, fe) if final else ():
+        for link in sorted(links):
+            if unaligned(*link):
+                alignment.add(link)
+    return alignment
+
+
+@pytest.mark.parametrize('heuristic', ['grow-diag', 'grow-diag-final'])
+def test_symmetrize_matches_grid_scan(heuristic):
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        ef, fe = ({(e, f) for e, f in rng.randint(0, 6, (rng.randint(0, 12), 2)).tolist()} for _ in range(2))
+        expected = sorted(grow_diag_final(ef, fe, heuristic == 'grow-diag-final'))
+        assert ibm.symmetrize(links(ef, 3), links(fe, 3), heuristic)[:, 1:].tolist() == [list(x) for x in expected]
+
+
+def train(numerics, K):
+    """Train IBM1 on dev for K iterations, returning theta and the log-likelihood of every iteration"""
+    en_train, fr_train = read_sentences(DEV + '.e', null=True), read_sentences(DEV + '.f')
+    theta = ibm.init_theta(en_train, fr_train).set_numerics(numerics)
+    corpus = theta.encode(en_train, fr_train)
+    loglikelihoods = []
+    for k in range(K):
+        counts, _, loglikelihood, _ = ibm.e_step(theta, corpus)
+        ibm.m_step(theta, counts)
+        loglikelihoods.append(loglikelihood)
+    return theta, loglikelihoods
+
+
+# float32 rounds every probability to 24 bits (relative error 6e-8) and the error grows with
+# every iteration, on dev it reaches 6e-7 after 5. float64 and log-float64 only differ by the
+# rounding of log and exp, a few units of 1e-16.
+@pytest.mark.parametrize('numerics, rtol', [('float32', 1e-5), ('log-float64', 1e-12)])
+def test_numerics_agree_with_float64(numerics, rtol):
+    expected, expected_ll = train('float64', 5)
+    theta, loglikelihood = train(numerics, 5)
+    np.testing.assert_allclose(theta.numerics.decode(theta.data), expected.numerics.decode(expected.data), rtol=rtol)
+    np.testing.assert_allclose(loglikelihood, expected_ll, rtol=rtol)
+
+
+@pytest.mark.parametrize('numerics', ibm.Numerics.NAMES)
+@pytest.mark.parametrize('K, expected_aer', [(1, {'float32': 0.8584, 'float64': 0.8565, 'log-float64': 0.8565}),
+                                             (5, dict.fromkeys(ibm.Numerics.NAMES, 0.6761))])
+def test_viterbi_matches_decimal_up_to_ties(numerics, K, expected_aer):
+    # Probabilities that are equal in exact arithmetic come out of EM differing in the last
+    # digits, at 28 significant digits for Decimal and 16 or 7 for floats, so the two pick
+    # different first maxima. Every float link must still be a maximum of the Decimal
+    # probabilities within 1e-9, far above rounding. The AERs differ (0.8536 and 0.6742 for
+    # Decimal) and the float ones are pinned to 4 decimals.
+    en_val, fr_val = read_sentences(DEV + '.e'), read_sentences(DEV + '.f')
+    decimal = ibm._train_decimal(read_sentences(DEV + '.e', null=True), fr_val, K)
+    theta, _ = train(numerics, K)
+    aer_value, predictions = ibm.compute_aer(en_val, fr_val, DEV + '.wa.nonullalign', theta)
+    for links, en_n, fr_n in zip(predictions, en_val, fr_val):
+        for e, f in links:
+            p = [float(decimal[en][fr_n[f - 1]]) for en in en_n]
+            assert p[e - 1] >= max(p) * (1 - 1e-9)
+    assert aer_value == pytest.approx(expected_aer[numerics], abs=5e-5)
+
+
+@pytest.mark.parametrize('train_EM', [ibm.train_EM, ibm.train_EM_ibm2])
+@pytest.mark.parametrize('prune', [{'floor': 0.05}, {'top_k': 3}])
+def test_pruned_training_loglikelihood_is_finite(train_EM, prune):
+    # pruning leaves french tokens without any link, they are counted apart from the log-likelihood
+    en_train, fr_train = read_sentences(DEV + '.e', null=True), read_sentences(DEV + '.f')
+    en_val, fr_val = read_sentences(DEV + '.e'), read_sentences(DEV + '.f')
+    monitor = ibm.Monitor()
+    t_log = train_EM(en_train, fr_train, ibm.init_theta(en_train, fr_train), en_val, fr_val, en_val, fr_val,
+                     DEV + '.wa.nonullalign', K=4, monitor=monitor, **prune)[2]
+    assert np.isfinite(t_log).all()
+    zero_tokens = [stats['zero_tokens'] for stats in monitor.history]
+    assert zero_tokens[0] == 0 and max(zero_tokens) > 0
@@ -1,7 +1,10 @@
 import os
 import sys
+import itertools
 from nltk.tree import Tree
 import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
 from collections import Counter, OrderedDict, defaultdict
 
 
@@ -16,20 +19,74 @@ class OrderedCounter(Counter, OrderedDict):
 
 
 class Vocabulary:
-    """A vocabulary, assigns IDs to tokens"""
+    """
+    A vocabulary, assigns IDs to tokens
+
+    After freeze no tokens can be added, and whole corpora are mapped to and from IDs
+    at once with encode and decode.
+    """
 
     def __init__(self):
         self.freqs = OrderedCounter()
         self.w2i = {}
         self.i2w = []
+        self.frozen = False
 
     def count_token(self, t):
         self.freqs[t] += 1
 
     def add_token(self, t):
+        if self.frozen:
+            raise ValueError('Cannot add %r to a frozen vocabulary' % t)
         self.w2i[t] = len(self.w2i)
         self.i2w.append(t)
 
+    def freeze(self):
+        """Fix the tokens and build the array of decode"""
+        self.words = np.array(self.i2w)
+        self.frozen = True
+        return self
+
+    def encode(self, sentences, unk=0):
+        """
+        Map a list of tokenized sentences to IDs, unknown tokens get unk
+
+        Returns a flat int32 array of IDs and the int64 offsets of the sentences,
+        sentence n is ids[offsets[n]:offsets[n + 1]]
+        """
+        if not self.frozen:
+            self.freeze()
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        np.cumsum([len(sen) for sen in sentences], out=offsets[1:])
+        # the dictionary lookups run in C, without a Python loop over the tokens
+        tokens = itertools.chain.from_iterable(sentences)
+        ids = np.fromiter(map(self.w2i.get, tokens, itertools.repeat(unk)), dtype=np.int32, count=offsets[-1])
+        return ids, offsets
+
+    def decode(self, ids):
+        """Map an array of IDs (of any shape) to nested lists of tokens"""
+        if not self.frozen:
+            self.freeze()
+        return self.words[np.asarray(ids)].tolist()
+
+    def save(self, path):
+        """Save the tokens as one UTF-8 string table and their counts in an .npz file"""
+        table = '\n'.join(self.i2w).encode('utf-8')
+        np.savez(path, table=np.frombuffer(table, dtype=np.uint8),
+                 freqs=np.array([self.freqs.get(t, 0) for t in self.i2w], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        """Load a vocabulary written by save, it is frozen"""
+        vocab = cls()
+        with np.load(path) as data:
+            tokens = data['table'].tobytes().decode('utf-8').split('\n')
+            for t, freq in zip(tokens, data['freqs'].tolist()):
+                vocab.add_token(t)
+                if freq:
+                    vocab.freqs[t] = freq
+        return vocab.freeze()
+
     def build(self, min_freq=0):
         self.add_token("<unk>")  # reserve 0 for <unk> (unknown words)
         self.add_token("<pad>")  # reserve 1 for <pad>
@@ -43,3 +100,98 @@ class Vocabulary:
     def reset(self):
         self.w2i = {}
         self.i2w = []
+        self.frozen = False
+
+
+class TokenDataset(Dataset):
+    """
+    Encoded sentences in one contiguous tensor, sentence n is ids[offsets[n]:offsets[n + 1]]
+
+    Indexed with a list of sentence numbers it returns a padded batch (x, y, lengths), x holds every
+    sentence without its last token, y without its first, and lengths the unpadded length of both.
+    """
+
+    def __init__(self, ids, offsets, pad_value=1):
+        self.ids = torch.as_tensor(np.asarray(ids, dtype=np.int64))
+        self.offsets = torch.as_tensor(np.asarray(offsets, dtype=np.int64))
+        self.lengths = self.offsets[1:] - self.offsets[:-1]
+        self.pad_value = pad_value
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, batch):
+        batch = torch.as_tensor(batch, dtype=torch.int64)
+        lengths = self.lengths[batch] - 1
+        steps = torch.arange(int(lengths.max()))
+        # position in ids of every token of x, padding points at the first token of the sentence
+        mask = steps < lengths[:, None]
+        positions = torch.where(mask, self.offsets[batch, None] + steps, self.offsets[batch, None])
+        x = self.ids[positions].masked_fill_(~mask, self.pad_value)
+        y = self.ids[positions + 1].masked_fill_(~mask, self.pad_value)
+        return x, y, lengths
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of sentences of similar length, which need little padding
+
+    Every epoch the sentences are shuffled, grouped by length bucket (length // bucket_width) and cut
+    into batches of batch_size, then the order of the batches is shuffled. The sentences of a batch
+    are sorted by decreasing length.
+    With max_tokens the batches are cut when their padded size (sentences times longest length) would
+    exceed max_tokens instead, so short sentences make large batches and long sentences small ones.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_width=1, shuffle=True, seed=None, max_tokens=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.rng = np.random.RandomState(seed)
+
+    def _bounds(self, lengths):
+        """Start of every batch of sentences of the given lengths, and the end of the last one"""
+        if self.max_tokens is None:
+            return list(range(0, len(lengths), self.batch_size)) + [len(lengths)]
+        bounds = [0]
+        longest = 0
+        for i, length in enumerate(lengths.tolist()):
+            longest = max(longest, length)
+            # a sentence longer than the budget gets a batch of its own
+            if i > bounds[-1] and (i + 1 - bounds[-1]) * longest > self.max_tokens:
+                bounds.append(i)
+                longest = length
+        return bounds + [len(lengths)] if len(lengths) else bounds
+
+    def batches(self):
+        """The batches of one epoch as arrays of sentence numbers, in length order"""
+        order = self.rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = order[np.argsort(self.lengths[order] // self.bucket_width, kind='stable')]
+        bounds = self._bounds(self.lengths[order])
+        return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch[np.argsort(-self.lengths[batch], kind='stable')].tolist()
+
+    def __len__(self):
+        """The number of batches, with max_tokens that of the sentences sorted by length"""
+        return len(self._bounds(np.sort(self.lengths))) - 1
+
+
+def batch_loader(dataset, batch_size, bucket_width=1, shuffle=True, workers=0, seed=None, max_tokens=None):
+    """
+    DataLoader of the padded (x, y, lengths) batches of a TokenDataset, length bucketed by BucketBatchSampler
+
+    The batches are prepared by workers processes ahead of the training step and pinned when CUDA is used,
+    so they can be copied with .to(device, non_blocking=True). With max_tokens the batches hold at most
+    max_tokens tokens of x (padding included) rather than batch_size sentences.
+    """
+    sampler = BucketBatchSampler((dataset.lengths - 1).numpy(), batch_size, bucket_width, shuffle, seed, max_tokens)
+    return DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=workers,
+                      pin_memory=torch.cuda.is_available(), persistent_workers=workers > 0)
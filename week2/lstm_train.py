@@ -1,5 +1,5 @@
-from dataset import Vocabulary
-from pre_data import preprocess
+from dataset import TokenDataset, batch_loader
+from pre_data import load_treebanks
 import os
 import sys
 import time
@@ -7,7 +7,6 @@ from datetime import datetime
 import argparse
 import matplotlib.pyplot as plt
 import numpy as np
-import random
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -15,93 +14,69 @@ from lstm_model import LSTMLM
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
-train_data = preprocess(
-    open('./02-21.10way.clean', 'r', encoding='utf-8').read().splitlines())
+# the trees are parsed once, later runs load the cached ids
+train_set, val_set, test_set = load_treebanks(
+    ['./02-21.10way.clean', './22.auto.clean', './23.auto.clean'], './cache/treebank.npz')
 print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
-print('Number of sentences in training set: {}'.format(len(train_data)))
-val_data = preprocess(
-    open('./22.auto.clean', 'r', encoding='utf-8').read().splitlines())
-print('Number of sentences in validation set: {}'.format(len(val_data)))
-test_data = preprocess(
-    open('./23.auto.clean', 'r', encoding='utf-8').read().splitlines())
-print('Number of sentences in testing set: {}'.format(len(test_data)))
-vocab = Vocabulary()
-for sentence in train_data:
-  for word in sentence:
-      vocab.count_token(word)
-vocab.build()   # build the dictionary
+print('Number of sentences in training set: {}'.format(len(train_set)))
+print('Number of sentences in validation set: {}'.format(len(val_set)))
+print('Number of sentences in testing set: {}'.format(len(test_set)))
+vocab = train_set.vocabulary()   # build the dictionary
 vocab_size = len(vocab.w2i)
 print('Vocabulary size: {}'.format(vocab_size))
 print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
+# the corpora are mapped to ids once, the training batches are padded by DataLoader workers
+train_ids, train_offsets = train_set.encode(vocab)
+train_dataset = TokenDataset(train_ids, train_offsets)
+# training perplexity is measured on the first 500 sentences
+train_eval_dataset = TokenDataset(train_ids[:train_offsets[500]], train_offsets[:501])
+val_dataset = TokenDataset(*val_set.encode(vocab))
+test_dataset = TokenDataset(*test_set.encode(vocab))
 
 
-def prepare_example(example, vocab):
+def prepare_batches(dataset, batch_size):
   """
-  Map tokens to their IDs for 1 example
+  Padded (x, y) batches of a TokenDataset on the device, sorted by length,
+  built once and reused at every evaluation
   """
-  # vocab returns 0 if the word is not there
-  x = [vocab.w2i.get(t, 0) for t in example[:-1]]
-  x = torch.LongTensor([x])
-  x = x.to(device)
-  y = [vocab.w2i.get(t, 0) for t in example[1:]]
-  y = torch.LongTensor([y])
-  y = y.to(device)
-  return x, y
+  return [(x.to(device), y.to(device))
+          for x, y, _ in batch_loader(dataset, batch_size, shuffle=False)]
 
 
-def prepare_minibatch(mb, vocab):
+def compute_perplexity(prediction, target, pad_value=1):
   """
-  Minibatch is a list of examples.
-  This function converts words to IDs and returns
-  torch tensors to be used as input/targets.
+  Summed negative log-likelihood, number of tokens and number of correct argmax predictions
+  of a padded batch, prediction is (batch, length, vocabulary), padding targets are skipped
   """
-  maxlen = max([len(sen) for sen in mb]) - 1
-  # vocab returns 0 if the word is not there
-  x = [pad([vocab.w2i.get(t, 0) for t in sen[:-1]], maxlen) for sen in mb]
-  x = torch.LongTensor(x)
-  x = x.to(device)
-  y = [pad([vocab.w2i.get(t, 0) for t in sen[1:]], maxlen) for sen in mb]
-  y = torch.LongTensor(y)
-  y = y.to(device)
-  return x, y
-
-
-def get_minibatch(data, batch_size, shuffle=True):
-  """Return minibatches, optional shuffling"""
-  if shuffle:
-    print("Shuffling training data")
-    random.shuffle(data)  # shuffle training data each epoch
-  batch = []
-  # yield minibatches
-  for example in data:
-    batch.append(example)
-    if len(batch) == batch_size:
-      yield batch
-      batch = []
-  # in case there is something left
-  if len(batch) > 0:
-    yield batch
-
-
-def pad(tokens, length, pad_value=1):
-  """add padding 1s to a sequence to that it has the desired length"""
-  return tokens + [pad_value] * (length - len(tokens))
-
-
-def compute_perplexity(prediction, target):
-  prediction = nn.functional.softmax(prediction, dim=2)
-  perplexity = 0
-  for i in range(prediction.shape[0]):
-    for j in range(prediction.shape[1]):
-      perplexity -= torch.log(prediction[i][j][int(target[i][j])])
-  return float(perplexity)
-
-
-def compute_match(prediction, target):
-  match = 0
-  pred = prediction.argmax(dim=2)
-  match += (pred == target).sum().item()
-  return int(match)
+  # flattened to (tokens, vocabulary), which is much faster than a transposed view
+  nll = nn.functional.cross_entropy(prediction.reshape(-1, prediction.shape[-1]), target.reshape(-1),
+                                    ignore_index=pad_value, reduction='sum')
+  mask = target != pad_value
+  match = (prediction.argmax(dim=2) == target) & mask
+  return float(nll), int(mask.sum()), int(match.sum())
+
+
+def evaluate(model, batches, config):
+  """
+  Summed negative log-likelihood, number of tokens and number of correct predictions
+  of the model on the batches of prepare_batches, one forward pass per batch
+  """
+  model.eval()
+  nll, length, match = 0.0, 0, 0
+  with torch.no_grad():
+    for inputs, targets in batches:
+      h_0 = torch.zeros(config.lstm_num_layers,
+                        inputs.shape[0], config.lstm_num_hidden).to(device)
+      c_0 = torch.zeros(config.lstm_num_layers,
+                        inputs.shape[0], config.lstm_num_hidden).to(device)
+      # the LSTM runs left to right, so padding at the end does not change the
+      # predictions of the tokens, and compute_perplexity skips the padding targets
+      pred, _, _ = model(inputs, h_0, c_0)
+      tmp_nll, tmp_length, tmp_match = compute_perplexity(pred, targets)
+      nll += tmp_nll
+      length += tmp_length
+      match += tmp_match
+  return nll, length, match
 
 
 def train(config):
@@ -133,8 +108,13 @@ def train(config):
   iter_i = 0
   best_perp = 1e6
 
+  train_eval_batches = prepare_batches(train_eval_dataset, config.eval_batch_size)
+  val_batches = prepare_batches(val_dataset, config.eval_batch_size)
+  train_loader = batch_loader(train_dataset, config.batch_size, bucket_width=config.bucket_width,
+                              workers=config.workers, max_tokens=config.max_tokens_per_batch)
+
   while True:  # when we run out of examples, shuffle and continue
-    for train_batch in get_minibatch(train_data, batch_size=config.batch_size):
+    for inputs, targets, _ in train_loader:
 
       # Only for time measurement of step through network
       t1 = time.time()
@@ -143,7 +123,8 @@ def train(config):
       model.train()
       optimizer.zero_grad()
 
-      inputs, targets = prepare_minibatch(train_batch, vocab)
+      inputs = inputs.to(device, non_blocking=True)
+      targets = targets.to(device, non_blocking=True)
 
       h_0 = torch.zeros(config.lstm_num_layers,
                         inputs.shape[0], config.lstm_num_hidden).to(device)
@@ -167,51 +148,14 @@ def train(config):
         avg_loss = sum(tmp_loss) / len(tmp_loss)
         tmp_loss = list()
 
-        model.eval()
-        t_perp = list()
-        t_match = list()
-        t_length = list()
-        perp = list()
-        match = list()
-        length = list()
-
-        for t_sen in train_data[:500]:
-          t_input, t_target = prepare_example(t_sen, vocab)
-          h_0 = torch.zeros(config.lstm_num_layers,
-                            t_input.shape[0], config.lstm_num_hidden).to(device)
-          c_0 = torch.zeros(config.lstm_num_layers,
-                            t_input.shape[0], config.lstm_num_hidden).to(device)
-
-          with torch.no_grad():
-            t_pred, _, _ = model(t_input, h_0, c_0)
-          t_tmp_per = compute_perplexity(t_pred, t_target)
-          t_tmp_match = compute_match(t_pred, t_target)
-          t_perp.append(t_tmp_per)
-          t_match.append(t_tmp_match)
-          t_length.append(t_target.shape[1])
-
-        t_nll = sum(t_perp) / 500 * 39832
-        t_perplexity = np.exp(sum(t_perp) / sum(t_length))
-        t_accuracy = sum(t_match) / sum(t_length)
-
-        for val_sen in val_data:
-          val_input, val_target = prepare_example(val_sen, vocab)
-          h_0 = torch.zeros(
-              config.lstm_num_layers, val_input.shape[0], config.lstm_num_hidden).to(device)
-          c_0 = torch.zeros(
-              config.lstm_num_layers, val_input.shape[0], config.lstm_num_hidden).to(device)
-
-          with torch.no_grad():
-            val_pred, _, _ = model(val_input, h_0, c_0)
-          tmp_per = compute_perplexity(val_pred, val_target)
-          tmp_match = compute_match(val_pred, val_target)
-          perp.append(tmp_per)
-          match.append(tmp_match)
-          length.append(val_target.shape[1])
-
-        nll = sum(perp)
-        perplexity = np.exp(nll / sum(length))
-        accuracy = sum(match) / sum(length)
+        t_perp, t_length, t_match = evaluate(model, train_eval_batches, config)
+        t_nll = t_perp / len(train_eval_dataset) * 39832
+        t_perplexity = np.exp(t_perp / t_length)
+        t_accuracy = t_match / t_length
+
+        nll, length, match = evaluate(model, val_batches, config)
+        perplexity = np.exp(nll / length)
+        accuracy = match / length
 
         if perplexity < best_perp:
           best_perp = perplexity
@@ -248,28 +192,10 @@ def train(config):
   print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
 
   model.load_state_dict(torch.load('./models/lstm_best.pt'))
-  model.eval()
-  perp = list()
-  match = list()
-  length = list()
-
-  for test_sen in test_data:
-    test_input, test_target = prepare_example(test_sen, vocab)
-    h_0 = torch.zeros(config.lstm_num_layers,
-                      test_input.shape[0], config.lstm_num_hidden).to(device)
-    c_0 = torch.zeros(config.lstm_num_layers,
-                      test_input.shape[0], config.lstm_num_hidden).to(device)
-    with torch.no_grad():
-      test_pred, _, _ = model(test_input, h_0, c_0)
-    tmp_per = compute_perplexity(test_pred, test_target)
-    tmp_match = compute_match(test_pred, test_target)
-    perp.append(tmp_per)
-    match.append(tmp_match)
-    length.append(test_target.shape[1])
-
-  test_nll = sum(perp)
-  test_perplexity = np.exp(test_nll / sum(length))
-  test_accuracy = sum(match) / sum(length)
+  test_batches = prepare_batches(test_dataset, config.eval_batch_size)
+  test_nll, test_length, test_match = evaluate(model, test_batches, config)
+  test_perplexity = np.exp(test_nll / test_length)
+  test_accuracy = test_match / test_length
 
   print('Test Perplexity on the best model is: {:3f}'.format(test_perplexity))
   print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
@@ -399,8 +325,14 @@ if __name__ == "__main__":
                         default=2, help='Number of LSTM layers in the model')
     parser.add_argument('--batch_size', type=int, default=25,
                         help='Batch size of the input')
+    parser.add_argument('--bucket_width', type=int, default=1,
+                        help='Width of the length buckets the batches are drawn from')
+    parser.add_argument('--max_tokens_per_batch', type=int, default=None,
+                        help='Fill the batches up to this many (padded) tokens instead of batch_size sentences')
 
     # Training params
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of DataLoader processes preparing the batches')
     parser.add_argument('--learning_rate', type=float,
                         default=2e-3, help='Learning rate')
     parser.add_argument('--dropout_keep_prob', type=float,
@@ -413,6 +345,8 @@ if __name__ == "__main__":
     # Misc params
     parser.add_argument('--eval_every', type=int, default=100,
                         help='How often to print and evaluate training progress')
+    parser.add_argument('--eval_batch_size', type=int, default=32,
+                        help='Batch size of the evaluation')
     parser.add_argument('--sample_size', type=int, default=10,
                         help='Number of sampled sentences')
 
@@ -1,6 +1,23 @@
 import os
+import re
 import sys
-from nltk.tree import Tree
+import multiprocessing as mp
+import numpy as np
+from dataset import Vocabulary
+
+# a leaf is a token after whitespace, node labels follow an opening bracket
+LEAF = re.compile(r'(?<=\s)[^\s()]+')
+
+# bytes of a treebank file handled by one task of the extraction pool
+CHUNK_BYTES = 1 << 20
+
+
+def tree_leaves(tree):
+    """
+    Input {str}: a bracketed tree
+    Output {list}: its leaves, the same as Tree.fromstring(tree).leaves() without building the tree
+    """
+    return LEAF.findall(tree)
 
 
 def preprocess(data):
@@ -13,8 +30,119 @@ def preprocess(data):
     """
     processed = list()
     for tree in data:
-        tree = Tree.fromstring(tree)
-        sen = tree.leaves()
+        sen = tree_leaves(tree)
         sen = ["SOS"] + sen + ["EOS"]
         processed.append(sen)
     return processed
+
+
+def _file_chunks(path, chunk_bytes=CHUNK_BYTES):
+    """Split a file into (path, start, end) byte ranges that begin and end at line boundaries"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as file:
+        while bounds[-1] < size:
+            file.seek(min(bounds[-1] + chunk_bytes, size))
+            file.readline()
+            bounds.append(min(file.tell(), size))
+    return [(path, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _preprocess_chunk(chunk):
+    path, start, end = chunk
+    with open(path, 'rb') as file:
+        file.seek(start)
+        lines = file.read(end - start).decode('utf-8').splitlines()
+    return preprocess(lines)
+
+
+def read_treebank(path, workers=None):
+    """
+    Input {str}: path of a tree corpus with one tree per line
+    Output {list}: the sentence corpus of preprocess, the file is split into chunks parsed by a pool of workers
+    """
+    chunks = _file_chunks(path)
+    if workers == 1 or len(chunks) == 1:
+        return [sen for chunk in chunks for sen in _preprocess_chunk(chunk)]
+    with mp.Pool(workers) as pool:
+        return [sen for part in pool.map(_preprocess_chunk, chunks) for sen in part]
+
+
+class Treebank:
+    """
+    Sentences of a tree corpus stored as flat id arrays.
+
+    Sentence n is [words[i] for i in ids[offsets[n]:offsets[n + 1]]], words is shared by
+    all treebanks loaded together and lists every token in the order it is first seen.
+    """
+
+    def __init__(self, words, ids, offsets):
+        self.words = words
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sentence(self, n):
+        return [self.words[i] for i in self.ids[self.offsets[n]:self.offsets[n + 1]].tolist()]
+
+    def sentences(self):
+        """All sentences as lists of tokens, like preprocess"""
+        tokens = [self.words[i] for i in self.ids.tolist()]
+        offsets = self.offsets.tolist()
+        return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def encode(self, vocab):
+        """
+        The ids of vocab (a dataset.Vocabulary) of all tokens, the same as vocab.encode(self.sentences())
+        Only the word table is looked up, the tokens are mapped with one array index.
+        """
+        table, _ = vocab.encode([self.words])
+        return table[self.ids], self.offsets
+
+    def vocabulary(self, min_freq=0):
+        """A dataset.Vocabulary built on this treebank, the same as counting every token of sentences()"""
+        counts = np.bincount(self.ids, minlength=len(self.words))
+        # count the words in the order they first occur, which breaks frequency ties in build
+        seen, first = np.unique(self.ids, return_index=True)
+        vocab = Vocabulary()
+        for i in seen[np.argsort(first)].tolist():
+            vocab.freqs[self.words[i]] = int(counts[i])
+        vocab.build(min_freq)
+        return vocab
+
+
+def load_treebanks(paths, cache_path=None, workers=None):
+    """
+    Input {list}: paths of tree corpora, e.g. the training, validation and testing sets
+    Output {list}: a Treebank of SOS/EOS-wrapped sentences for every path
+    The trees are parsed in parallel the first time and the ids are cached in cache_path (.npz),
+    later calls with the same paths only load the cache, until one of the files is modified.
+    Example usage:
+        from pre_data import load_treebanks
+        train_set, val_set, test_set = load_treebanks(
+            ['./02-21.10way.clean', './22.auto.clean', './23.auto.clean'], './cache/treebank.npz')
+        vocab = train_set.vocabulary()
+    """
+    sources = [os.path.abspath(path) for path in paths]
+    mtimes = [os.path.getmtime(path) for path in paths]
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if 'paths' in cache and cache['paths'].tolist() == sources and np.array_equal(cache['mtimes'], mtimes):
+                words = cache['words'].tolist()
+                return [Treebank(words, cache['ids_%d' % k], cache['offsets_%d' % k]) for k in range(len(paths))]
+
+    w2i = {}
+    arrays = {}
+    for k, path in enumerate(paths):
+        sentences = read_treebank(path, workers)
+        ids = np.array([w2i.setdefault(w, len(w2i)) for sen in sentences for w in sen], dtype=np.int32)
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        np.cumsum([len(sen) for sen in sentences], out=offsets[1:])
+        arrays['ids_%d' % k], arrays['offsets_%d' % k] = ids, offsets
+    words = list(w2i)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        np.savez(cache_path, words=np.array(words), paths=np.array(sources), mtimes=np.array(mtimes), **arrays)
+    return [Treebank(words, arrays['ids_%d' % k], arrays['offsets_%d' % k]) for k in range(len(paths))]
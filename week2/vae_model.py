@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
@@ -98,6 +99,103 @@ class VAE(nn.Module):
         self.device = device
         self.to(device)
 
+    def encode(self, x, h_0, c_0, lengths_in_batch):
+        """
+        The embedded input of the batch x and the mean and log variance of q(z|x)
+        """
+        # embed input
+        embedded = self.embedding(x)
+
+        # remove the paddings for faster computation
+        packed_embedded = pack_padded_sequence(
+            embedded,
+            lengths=lengths_in_batch,
+            batch_first=True,
+            enforce_sorted=False)
+
+        # feed pad_removed input into encoder
+        _, (h_t_packed, _) = self.biLSTM_encoder(packed_embedded, (h_0, c_0))
+
+        # The h_t_packed has weird dim = (num_layer * num direction) * batch * lstm_hidden = 2 * batch * 128(lstm_num_hidden)
+        # have to concat the 2 directions of 128 hidden states back to 256
+        # s.t. its dim now =  batch * 256
+        encoder_output = torch.cat((h_t_packed[0], h_t_packed[1]), dim=1)
+
+        # mean and log variance
+        return embedded, self.mu(encoder_output), self.logvar(encoder_output)
+
+    def decode(self, embedded, lengths_in_batch, z):
+        """
+        Decoder logits of the embedded input for k samples of z of shape (k, batch, num_latent),
+        the samples are folded into the batch so the decoder runs once, the output is
+        (k, batch, sent_len, vocabsize)
+        """
+        # sample k of sentence b is row k * batch + b of the decoder batch
+        k, batch = z.shape[:2]
+
+        # map the latent dimensions of z back to the lstm_num_hidden
+        # dimensions
+        decoder_input = self.latent2decoder(z.reshape(k * batch, self.num_latent))
+
+        # unsqueeze is for adding one dim of 1 to fit the input constraint of LSTM:
+        # Inputs: input, (h_0, c_0); h_0 of shape (num_layers *
+        # num_directions, batch, hidden_size)
+        decoder_hidden_init = decoder_input.unsqueeze(0)
+
+        # Use this instead if take init cell state as empty: (which is the
+        # first attempt)
+        decoder_cell_init = torch.zeros(
+            1, k * batch, self.lstm_num_hidden).to(self.device)
+
+        # the input sentences repeated for every sample of z, with the padding removed
+        packed_repeated = pack_padded_sequence(
+            embedded.repeat(k, 1, 1),
+            lengths=torch.as_tensor(lengths_in_batch).repeat(k),
+            batch_first=True,
+            enforce_sorted=False)
+
+        h_N_packed, (_, _) = self.LSTM_decoder(
+            packed_repeated, (decoder_hidden_init, decoder_cell_init))
+
+        # h_N_unpacked contains hidden states output of all timesteps
+        h_N_unpacked, _ = pad_packed_sequence(h_N_packed, batch_first=True)
+
+        # decoder output is the fully-connected layer from num_hidden to vocab size,
+        # Then in train.py we will use nn.CrossEntropy as the softmax to calculate the loss from this decoder_ouput
+        return self.LSTM_output(h_N_unpacked).view(k, batch, h_N_unpacked.size(1), -1)
+
+    @torch.no_grad()
+    def log_likelihood(self, x, h_0, c_0, lengths_in_batch, targets,
+                       importance_sampling_size, chunk_size=None, pad_value=1):
+        """
+        Importance weighted estimate of log p(targets | x) of every sentence of the batch,
+        logsumexp_k [log p(x|z_k) + log p(z_k) - log q(z_k|x)] - log K with z_k drawn from q(z|x).
+        The K samples are decoded chunk_size at a time and combined with a running
+        logsumexp, so the memory does not grow with K.
+        """
+        embedded, mu, logvar = self.encode(x, h_0, c_0, lengths_in_batch)
+        std = torch.exp(.5 * logvar)
+        chunk_size = chunk_size or importance_sampling_size
+
+        log_px = torch.full((x.size(0), ), -float('inf'), device=mu.device)
+        for start in range(0, importance_sampling_size, chunk_size):
+            k = min(chunk_size, importance_sampling_size - start)
+            epsilon = torch.randn((k, ) + mu.shape).to(self.device)
+            z = epsilon * std + mu
+
+            decoder_output = self.decode(embedded, lengths_in_batch, z)
+            log_px_z = -nn.functional.cross_entropy(
+                decoder_output.reshape(-1, decoder_output.shape[-1]), targets.repeat(k, 1).reshape(-1),
+                ignore_index=pad_value, reduction='none').view(k, x.size(0), -1).sum(dim=2)
+
+            # standard normal prior and diagonal Gaussian posterior, the log(2 pi) terms cancel
+            log_pz = -.5 * z.pow(2).sum(dim=2)
+            log_qz = -.5 * (epsilon.pow(2) + logvar).sum(dim=2)
+
+            log_px = torch.logaddexp(log_px, torch.logsumexp(log_px_z + log_pz - log_qz, dim=0))
+
+        return log_px - math.log(importance_sampling_size)
+
     def forward(
             self,
             x,
@@ -170,100 +268,21 @@ class VAE(nn.Module):
         print('x',x)
         '''
 
-        # embed input
-        embedded = self.embedding(x)
-
-        # remove the paddings for faster computation
-        packed_embedded = pack_padded_sequence(
-            embedded,
-            lengths=lengths_in_batch,
-            batch_first=True,
-            enforce_sorted=False)
-
-        # feed pad_removed input into encoder
-        # h_N_packed, (h_t_packed, c_t_packed) = self.biLSTM_encoder(packed_embedded, (h_0, c_0))
-        _, (h_t_packed, _) = self.biLSTM_encoder(packed_embedded, (h_0, c_0))
-
-        '''
-        In case this is needed in future: to convert h_N_unpacked(padding removed) back to h_N_unpacked(with padding - padded position has [0,...0] as h_i); 
-        dim of h_N_unpacked = batch * sent * (lstm_num_hidden * #direction * #layer)
-
-        h_N_unpacked, lengths_in_batch_just_the_same = pad_packed_sequence(h_N_packed, batch_first=True)
-        '''
-
-        # The h_t_packed has weird dim = (num_layer * num direction) * batch * lstm_hidden = 2 * batch * 128(lstm_num_hidden)
-        # have to concat the 2 directions of 128 hidden states back to 256
-        # s.t. its dim now =  batch * 256
-        encoder_output = torch.cat((h_t_packed[0], h_t_packed[1]), dim=1)
-
-        # mean
-        mu = self.mu(encoder_output)
-
-        # log variance
-        logvar = self.logvar(encoder_output)
+        embedded, mu, logvar = self.encode(x, h_0, c_0, lengths_in_batch)
 
         # std
         std = torch.exp(.5 * logvar)
 
-        for k in range(importance_sampling_size):
-
-            # introduce the epsilon randomness (actually default of requires
-            # grad is already false, anyway ...)
-            z = torch.randn((mu.shape), requires_grad=False).to(self.device)
-
-            # compute z
-            z = z * std + mu
-
-            # compute the KL loss
-            if k == 0:
-                KL_loss = 0.5 * \
-                    torch.sum(logvar.exp() + mu.pow(2) -
-                              1 - logvar)  # initialize
-            else:
-                # add if there k>=1 samples of z
-                KL_loss += 0.5 * \
-                    torch.sum(logvar.exp() + mu.pow(2) - 1 - logvar)
-
-            # map the latent dimensions of z back to the lstm_num_hidden
-            # dimensions
-            decoder_input = self.latent2decoder(z)
-
-            # unsqueeze is for adding one dim of 1 to fit the input constraint of LSTM:
-            # Inputs: input, (h_0, c_0); h_0 of shape (num_layers *
-            # num_directions, batch, hidden_size)
-            decoder_hidden_init = decoder_input.unsqueeze(0)
-
-            # use this if want to init cell state with z as well:
-            # decoder_cell_init = decoder_input.clone().unsqueeze(0)
-
-            # Use this instead if take init cell state as empty: (which is the
-            # first attempt)
-            decoder_cell_init = torch.zeros(
-                1, x.size(0), self.lstm_num_hidden).to(self.device)
-
-            # feed this new z to the LSTM decoder to get all the hidden states
-            # Am I right to feeed z to initial hidden states (instead of cell
-            # states?)
-            h_N_packed, (_, _) = self.LSTM_decoder(
-                packed_embedded, (decoder_hidden_init, decoder_cell_init))
-
-            # h_N_unpacked contains hidden states output of all timesteps
-            # unused return value is the the lengths_in_batch: h_N_unpacked,
-            # lengths_in_batch = pad_packed_sequence(h_N_packed,
-            # batch_first=True)
-            h_N_unpacked, _ = pad_packed_sequence(h_N_packed, batch_first=True)
-
-            # decoder output is the fully-connected layer from num_hidden to vocab size,
-            # Then in train.py we will use nn.CrossEntropy as the softmax to calculate the loss from this decoder_ouput
-            # initialize st it now becomes (1, batch, sent_len, vocabsize)
-            if k == 0:
-                decoder_output = torch.unsqueeze(
-                    self.LSTM_output(h_N_unpacked), dim=0)
-            # use concat with unsqueeze. Finally it will become (k, batch,
-            # sent_len, vocabsize)
-            else:
-                decoder_output = torch.cat((decoder_output, torch.unsqueeze(
-                    self.LSTM_output(h_N_unpacked), dim=0)), dim=0)
+        # k samples of z for every sentence, (k, batch, num_latent)
+        z = torch.randn((importance_sampling_size, ) + mu.shape,
+                        requires_grad=False).to(self.device)
+        z = z * std + mu
+
+        # the KL loss of every sample, it does not depend on z
+        KL_loss = importance_sampling_size * 0.5 * \
+            torch.sum(logvar.exp() + mu.pow(2) - 1 - logvar)
+
+        decoder_output = self.decode(embedded, lengths_in_batch, z)
 
         # print('decoder_output size', decoder_output.size())
         # print('KL_loss', KL_loss)
@@ -271,269 +290,67 @@ class VAE(nn.Module):
         return decoder_output, KL_loss
 
     @torch.no_grad()
-    def sample(self, sample_size, vocab):
+    def greedy_decode(self, z, sos, eos, max_length=50):
+        """
+        Greedy decoding of the samples z (batch, num_latent), one word per step,
+        the decoder state (h, c) is carried between the steps so only the last word is fed.
+        Stops after max_length words or once every sentence has produced eos,
+        returns the (batch, length) word ids, which go on after eos in sentences that ended early
+        """
+        # the decoder starts from z as the hidden state and an empty cell state
+        h = self.latent2decoder(z).unsqueeze(0)
+        c = torch.zeros_like(h)
+
+        next_word = torch.full((z.size(0), 1), sos, dtype=torch.long, device=z.device)
+        ended = torch.zeros(z.size(0), dtype=torch.bool, device=z.device)
+        words = list()
+        for s in range(max_length):  # mx sequence length
+            hidden_output, (h, c) = self.LSTM_decoder(self.embedding(next_word), (h, c))
+
+            # size = (batch, 1), argmax of the logits is that of the softmax
+            next_word = self.LSTM_output(hidden_output).argmax(dim=2)
+            words.append(next_word)
+
+            ended |= next_word.squeeze(1) == eos
+            if ended.all():
+                break
+
+        return torch.cat(words, dim=1)
+
+    def _sentences(self, z, vocab):
+        prediction_greedy_max = self.greedy_decode(z, vocab.w2i['SOS'], vocab.w2i['EOS'])
+        return [[vocab.i2w[word_idx] for word_idx in k] for k in prediction_greedy_max.tolist()]
 
+    @torch.no_grad()
+    def sample(self, sample_size, vocab):
         z = torch.randn((sample_size, self.num_latent),
                         requires_grad=False).to(self.device)
-        # print('z size', z.size())
-
-        decoder_input = self.latent2decoder(z)
-
-        # unsqueeze is for adding one dim of 1 to fit the input constraint of LSTM:
-        # Inputs: input, (h_0, c_0); h_0 of shape (num_layers * num_directions,
-        # batch, hidden_size)
-        decoder_hidden_init = decoder_input.unsqueeze(0)
-
-        # Use this instead if take init cell state as empty: (which is the
-        # first attempt)
-        decoder_cell_init = torch.zeros(
-            1, sample_size, self.lstm_num_hidden).to(self.device)
-
-        # create the sos inputs for size = (k, 1) then embed it to (k, 1,
-        # lstm_num_hidden)
-        sos_input = torch.LongTensor(
-            [[4] for x in range(sample_size)]).to(self.device)
-        embedded_sos_input = self.embedding(sos_input)
-        '''
-        for s in range(5): #mx sequence length
-
-            # feed the first input to LSTM to get the next words
-            # hidden_output of shape ( batch,seq_len=1, lstm_num_hidden)
-            if s==0:
-                hidden_output, (h,c) = self.LSTM_decoder(embedded_sos_input, (decoder_hidden_init, decoder_cell_init))
-            else:
-                hidden_output, (h,c) = self.LSTM_decoder(next_input, (h, c))
-
-            decoder_output=self.LSTM_output(hidden_output)
-
-            prediction = nn.functional.softmax(decoder_output, dim=2)#size = (s, 1, vocab_size)
-            print('prediction', prediction)
-
-            next_word = torch.argmax(prediction, dim=2) #k*1
-            print('next_word',next_word)
-
-            if s==0:
-                prediction_greedy_max = next_word
-            else:
-                prediction_greedy_max = torch.cat((prediction_greedy_max, next_word),dim=1)
-
-            next_input = self.embedding(next_word)
-            print(next_word)
-        '''
-        for s in range(50):  # mx sequence length
-
-            # feed the first input to LSTM to get the next words
-            # hidden_output of shape ( batch,seq_len=1, lstm_num_hidden)
-            if s == 0:
-                hidden_output, (h, c) = self.LSTM_decoder(
-                    embedded_sos_input, (decoder_hidden_init, decoder_cell_init))
-            else:
-                hidden_output, (h, c) = self.LSTM_decoder(
-                    next_input, (decoder_hidden_init, decoder_cell_init))
-
-            # get only the last hidden state
-            decoder_output = self.LSTM_output(hidden_output[:, -1:, :])
-
-            prediction = nn.functional.softmax(
-                decoder_output, dim=2)  # size = (k, 1,vocab_size)
-            # print('prediction', prediction)
-
-            next_word = torch.argmax(prediction, dim=2)  # k*1
-            # print('next_word',next_word)
-
-            if s == 0:
-                prediction_greedy_max = next_word
-            else:
-                prediction_greedy_max = torch.cat(
-                    (prediction_greedy_max, next_word), dim=1)
-
-            next_input = self.embedding(prediction_greedy_max)
-
-        # print('prediction_greedy_max ', prediction_greedy_max)
-
-        sampled_setences = [[vocab.i2w[word_idx]
-                             for word_idx in k] for k in prediction_greedy_max]
-
-        # print('sampled_setences',sampled_setences)
-
-        return sampled_setences
+        return self._sentences(z, vocab)
 
     @torch.no_grad()
     def interpolation(self, vocab):
         # first make two z
-        z1z2 = torch.randn((2, self.num_latent),
-                           requires_grad=False).to(self.device)
-        # print('z1z2 size', z1z2.size())
+        z1, z2 = torch.randn((2, self.num_latent),
+                             requires_grad=False).to(self.device)
 
-        # then we concat the mean
-        mean_z = torch.unsqueeze(torch.mean(z1z2, dim=0), dim=0)
-        z = torch.cat((z1z2, mean_z), dim=0)
-
-        # then we concat z1*.8+ z2*.2 and likewise
-        z_82 = torch.unsqueeze((z1z2[0] * .8 + z1z2[1] * .2), dim=0)
-        z = torch.cat((z, z_82), dim=0)
-
-        z_28 = torch.unsqueeze((z1z2[0] * .2 + z1z2[1] * .8), dim=0)
-        z = torch.cat((z, z_28), dim=0)
-
-        decoder_input = self.latent2decoder(z)
-
-        # unsqueeze is for adding one dim of 1 to fit the input constraint of LSTM:
-        # Inputs: input, (h_0, c_0); h_0 of shape (num_layers * num_directions,
-        # batch, hidden_size)
-        decoder_hidden_init = decoder_input.unsqueeze(0)
-
-        # Use this instead if take init cell state as empty: (which is the
-        # first attempt)
-        decoder_cell_init = torch.zeros(
-            1, 5, self.lstm_num_hidden).to(self.device)
-
-        # create the sos inputs for size = (k, 1) then embed it to (k, 1,
-        # lstm_num_hidden)
-        sos_input = torch.LongTensor([[4] for x in range(5)]).to(self.device)
-        embedded_sos_input = self.embedding(sos_input)
-
-        for s in range(50):  # mx sequence length
-
-            # feed the first input to LSTM to get the next words
-            # hidden_output of shape ( batch,seq_len=1, lstm_num_hidden)
-            if s == 0:
-                hidden_output, (h, c) = self.LSTM_decoder(
-                    embedded_sos_input, (decoder_hidden_init, decoder_cell_init))
-            else:
-                hidden_output, (h, c) = self.LSTM_decoder(
-                    next_input, (decoder_hidden_init, decoder_cell_init))
-
-            # get only the last hidden state
-            decoder_output = self.LSTM_output(hidden_output[:, -1:, :])
-
-            prediction = nn.functional.softmax(
-                decoder_output, dim=2)  # size = (k, 1,vocab_size)
-            # print('prediction', prediction)
-
-            next_word = torch.argmax(prediction, dim=2)  # k*1
-            # print('next_word',next_word)
-
-            if s == 0:
-                prediction_greedy_max = next_word
-            else:
-                prediction_greedy_max = torch.cat(
-                    (prediction_greedy_max, next_word), dim=1)
-
-            next_input = self.embedding(prediction_greedy_max)
-
-        # print('prediction_greedy_max ', prediction_greedy_max)
-
-        sampled_setences = [[vocab.i2w[word_idx]
-                             for word_idx in k] for k in prediction_greedy_max]
-
-        # print('sampled_setences',sampled_setences)
-
-        return sampled_setences
+        # then z1, z2, their mean, z1*.8+ z2*.2 and z1*.2+ z2*.8
+        z = torch.stack((z1, z2, (z1 + z2) / 2, z1 * .8 + z2 * .2, z1 * .2 + z2 * .8))
+        return self._sentences(z, vocab)
 
     @torch.no_grad()
     def test_reconstruction(self, test_sent, vocab):
         x = test_sent
-        lengths_in_batch = [1]
         importance_sampling_size = 10
 
-        embedded = self.embedding(x)
-
-        # remove the paddings for faster computation
-        packed_embedded = pack_padded_sequence(
-            embedded,
-            lengths=lengths_in_batch,
-            batch_first=True,
-            enforce_sorted=False)
-
-        # feed pad_removed input into encoder
-        # h_N_packed, (h_t_packed, c_t_packed) = self.biLSTM_encoder(packed_embedded, (h_0, c_0))
-        _, (h_t_packed, _) = self.biLSTM_encoder(packed_embedded)
-
-        '''
-        In case this is needed in future: to convert h_N_unpacked(padding removed) back to h_N_unpacked(with padding - padded position has [0,...0] as h_i); dim of h_N_unpacked = batch * sent * (lstm_num_hidden * #direction * #layer)
-
-        h_N_unpacked, lengths_in_batch_just_the_same = pad_packed_sequence(h_N_packed, batch_first=True)
-        '''
-
-        # The h_t_packed has weird dim = (num_layer * num direction) * batch * lstm_hidden = 2 * batch * 128(lstm_num_hidden)
-        # have to concat the 2 directions of 128 hidden states back to 256
-        # s.t. its dim now =  batch * 256
-        encoder_output = torch.cat((h_t_packed[0], h_t_packed[1]), dim=1)
-
-        # mean
-        mu = self.mu(encoder_output)
-
-        # log variance
-        logvar = self.logvar(encoder_output)
+        # the encoder starts from zero states, as in training
+        h_0 = torch.zeros(self.biLSTM_encoder.num_layers * 2, x.size(0),
+                          self.lstm_num_hidden).to(self.device)
+        _, mu, logvar = self.encode(x, h_0, torch.zeros_like(h_0), [x.size(1)])
 
         # std
         std = torch.exp(.5 * logvar)
 
-        for k in range(importance_sampling_size):
-
-            # introduce the epsilon randomness (actually default of requires
-            # grad is already false, anyway ...)
-            init_z = torch.randn(
-                (mu.shape), requires_grad=False).to(self.device)
-
-            # compute z
-            if k == 0:
-                z = init_z * std + mu
-            else:
-                z = torch.cat((z, init_z * std + mu), dim=0)
-
-        decoder_input = self.latent2decoder(z)
-
-        # unsqueeze is for adding one dim of 1 to fit the input constraint of LSTM:
-        # Inputs: input, (h_0, c_0); h_0 of shape (num_layers * num_directions,
-        # batch, hidden_size)
-        decoder_hidden_init = decoder_input.unsqueeze(0)
-
-        # Use this instead if take init cell state as empty: (which is the
-        # first attempt)
-        decoder_cell_init = torch.zeros(
-            1, 10, self.lstm_num_hidden).to(self.device)
-
-        # create the sos inputs for size = (k, 1) then embed it to (k, 1,
-        # lstm_num_hidden)
-        sos_input = torch.LongTensor([[4] for x in range(10)]).to(self.device)
-        embedded_sos_input = self.embedding(sos_input)
-
-        for s in range(50):  # mx sequence length
-
-            # feed the first input to LSTM to get the next words
-            # hidden_output of shape ( batch,seq_len=1, lstm_num_hidden)
-            if s == 0:
-                hidden_output, (h, c) = self.LSTM_decoder(
-                    embedded_sos_input, (decoder_hidden_init, decoder_cell_init))
-            else:
-                hidden_output, (h, c) = self.LSTM_decoder(
-                    next_input, (decoder_hidden_init, decoder_cell_init))
-
-            # get only the last hidden state
-            decoder_output = self.LSTM_output(hidden_output[:, -1:, :])
-
-            prediction = nn.functional.softmax(
-                decoder_output, dim=2)  # size = (k, 1,vocab_size)
-            # print('prediction', prediction)
-
-            next_word = torch.argmax(prediction, dim=2)  # k*1
-            # print('next_word',next_word)
-
-            if s == 0:
-                prediction_greedy_max = next_word
-            else:
-                prediction_greedy_max = torch.cat(
-                    (prediction_greedy_max, next_word), dim=1)
-
-            next_input = self.embedding(prediction_greedy_max)
-
-        # print('prediction_greedy_max ', prediction_greedy_max)
-
-        sampled_setences = [[vocab.i2w[word_idx]
-                             for word_idx in k] for k in prediction_greedy_max]
-
-        # print('sampled_setences',sampled_setences)
-
-        return sampled_setences
+        # importance_sampling_size samples of z of the sentence
+        z = torch.randn((importance_sampling_size, self.num_latent),
+                        requires_grad=False).to(self.device) * std + mu
+        return self._sentences(z, vocab)
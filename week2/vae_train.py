@@ -1,5 +1,5 @@
-from dataset import Vocabulary
-from pre_data import preprocess
+from dataset import TokenDataset, batch_loader
+from pre_data import load_treebanks
 import os
 import sys
 import time
@@ -7,7 +7,6 @@ from datetime import datetime
 import argparse
 import matplotlib.pyplot as plt
 import numpy as np
-import random
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -16,24 +15,21 @@ from vae_model import VAE
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
-train_data = preprocess(
-    open('./02-21.10way.clean', 'r', encoding='utf-8').read().splitlines())
+# the trees are parsed once, later runs load the cached ids
+train_set, val_set, test_set = load_treebanks(
+    ['./02-21.10way.clean', './22.auto.clean', './23.auto.clean'], './cache/treebank.npz')
 print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
-print('Number of sentences in training set: {}'.format(len(train_data)))
-val_data = preprocess(
-    open('./22.auto.clean', 'r', encoding='utf-8').read().splitlines())
-print('Number of sentences in validation set: {}'.format(len(val_data)))
-test_data = preprocess(
-    open('./23.auto.clean', 'r', encoding='utf-8').read().splitlines())
-print('Number of sentences in testing set: {}'.format(len(test_data)))
-vocab = Vocabulary()
-for sentence in train_data:
-  for word in sentence:
-      vocab.count_token(word)
-vocab.build()   # build the dictionary
+print('Number of sentences in training set: {}'.format(len(train_set)))
+print('Number of sentences in validation set: {}'.format(len(val_set)))
+print('Number of sentences in testing set: {}'.format(len(test_set)))
+vocab = train_set.vocabulary()   # build the dictionary
 vocab_size = len(vocab.w2i)
 print('Vocabulary size: {}'.format(vocab_size))
 print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
+# the corpora are mapped to ids once, the training batches are padded by DataLoader workers
+train_dataset = TokenDataset(*train_set.encode(vocab))
+val_dataset = TokenDataset(*val_set.encode(vocab))
+test_dataset = TokenDataset(*test_set.encode(vocab))
 
 # print('train data head', train_data[0:5])
 # print('train data tail', train_data[-5:])
@@ -71,83 +67,66 @@ def prepare_example(example, vocab):
   return x, y
 
 
-def prepare_minibatch(mb, vocab):
+def compute_perplexity_vae(decoder_output, target, pad_value=1):
   """
-  Minibatch is a list of examples.
-  This function converts words to IDs and returns
-  torch tensors to be used as input/targets.
+  Summed negative log-likelihood, number of tokens and number of correct argmax predictions of a
+  padded batch, decoder_output is (k, batch, length, vocabulary), padding targets are skipped;
+  the word probabilities are averaged over the k samples of z before taking the log
   """
+  prediction_mean = nn.functional.softmax(decoder_output, dim=3).mean(dim=0)
+  mask = target != pad_value
+  nll = -torch.log(prediction_mean.gather(2, target.unsqueeze(2)).squeeze(2))[mask].sum()
+  match = (prediction_mean.argmax(dim=2) == target) & mask
+  return float(nll), int(mask.sum()), int(match.sum())
 
-  # sort the minibatch for padding removing before biLSTM
-  mb.sort(reverse=True, key=len)
-  maxlen = len(mb[0]) - 1
-
-  # maxlen = max([len(sen) for sen in mb]) - 1
-
-  # vocab returns 0 if the word is not there
-  x = [pad([vocab.w2i.get(t, 0) for t in sen[:-1]], maxlen) for sen in mb]
-  x = torch.LongTensor(x)
-  x = x.to(device)
-  y = [pad([vocab.w2i.get(t, 0) for t in sen[1:]], maxlen) for sen in mb]
-  y = torch.LongTensor(y)
-  y = y.to(device)
-
-  # also return the unpadded lengths of all sents in a batch
-  # (for the pack_padded function in VAE model forward, which removes the the padding for faster computation)
-  lengths_in_batch = [len(sen) - 1 for sen in mb]
-
-  return x, y, lengths_in_batch
-  # x is setnences from first word to secLast word (in vocab index)
-  # y is setnences from sec word to last word (in vocab index)
-
-
-def get_minibatch(data, batch_size, shuffle=True):
-  """Return minibatches, optional shuffling"""
-  if shuffle:
-    print("Shuffling training data")
-    random.shuffle(data)  # shuffle training data each epoch
-  batch = []
-  # yield minibatches
-  for example in data:
-    batch.append(example)
-    if len(batch) == batch_size:
-      yield batch
-      batch = []
-  # in case there is something left
-  if len(batch) > 0:
-    yield batch
-
-
-def pad(tokens, length, pad_value=1):
-  """add padding 1s to a sequence to that it has the desired length"""
-  return tokens + [pad_value] * (length - len(tokens))
 
+def prepare_batches(dataset, batch_size):
+  """
+  Padded (x, y, lengths) batches of a TokenDataset, x and y on the device, sorted by length,
+  built once and reused at every evaluation
+  """
+  return [(x.to(device), y.to(device), lengths)
+          for x, y, lengths in batch_loader(dataset, batch_size, shuffle=False)]
 
-# the negative log-likelihood term in perplexity(for RNNLM only)
-def compute_perplexity(prediction, target):
-  prediction = nn.functional.softmax(prediction, dim=2)
-  perplexity = 0
-  for i in range(prediction.shape[0]):  # batch shape  (=1 when validating)
-    # sentence length, ie 1 word/1 timestamp for each loop
-    for j in range(prediction.shape[1]):
-      perplexity -= torch.log(prediction[i][j][int(target[i][j])])
-  return float(perplexity)
 
+def evaluate(model, batches, config):
+  """
+  Importance sampled evaluation of the VAE on the batches of prepare_batches, the
+  config.importance_sampling_size samples of z of a whole batch are decoded in one call.
+  Returns the summed negative log-likelihood, number of tokens and number of correct
+  predictions of compute_perplexity_vae, and the summed negative ELBO of the sentences.
+  With config.perplexity_estimator 'iwae' the negative log-likelihood is that of
+  VAE.log_likelihood with config.iwae_samples samples instead
+  """
+  model.eval()
+  nll, length, match, elbo_loss = 0.0, 0, 0, 0.0
+  k = config.importance_sampling_size
+  with torch.no_grad():
+    for inputs, targets, lengths_in_batch in batches:
+      h_0 = torch.zeros(config.lstm_num_layers * config.lstm_num_direction,
+                        inputs.shape[0], config.lstm_num_hidden).to(device)
+      c_0 = torch.zeros(config.lstm_num_layers * config.lstm_num_direction,
+                        inputs.shape[0], config.lstm_num_hidden).to(device)
 
-'''
-def compute_match(prediction, target):
-  match = 0
-  pred = prediction.argmax(dim=2)
-  match += (pred == target).sum().item()
-  return int(match)
-'''
+      # decoder_output.size() = (k, batch, sent_length, vocabsize)
+      decoder_output, KL_loss = model(inputs, h_0, c_0, lengths_in_batch, k)
 
+      tmp_nll, tmp_length, tmp_match = compute_perplexity_vae(decoder_output, targets)
+      if config.perplexity_estimator == 'iwae':
+        # the importance weighted estimate of log p(x) with its own samples of z
+        tmp_nll = -float(model.log_likelihood(inputs, h_0, c_0, lengths_in_batch, targets,
+                                              config.iwae_samples, config.iwae_chunk_size).sum())
+      nll += tmp_nll
+      length += tmp_length
+      match += tmp_match
 
-def compute_match_vae(prediction, target):
-  match = 0
-  pred = prediction.argmax(dim=1)
-  match += (pred == target).sum().item()
-  return int(match)
+      # the reconstruction loss of every sample of every sentence, averaged over the
+      # k samples together with the KL loss (which model sums k times as well)
+      reconstruction_loss = nn.functional.cross_entropy(
+          decoder_output.reshape(-1, decoder_output.shape[-1]), targets.repeat(k, 1).reshape(-1),
+          ignore_index=1, reduction='sum')
+      elbo_loss += float(reconstruction_loss + KL_loss) / k
+  return nll, length, match, elbo_loss
 
 
 def train(config):
@@ -188,8 +167,13 @@ def train(config):
   iter_i = 0
   best_perp = 1e6
 
+  val_batches = prepare_batches(val_dataset, config.eval_batch_size)
+  train_eval_batches = prepare_batches(train_dataset, config.eval_batch_size)
+  train_loader = batch_loader(train_dataset, config.batch_size, bucket_width=config.bucket_width,
+                              workers=config.workers, max_tokens=config.max_tokens_per_batch)
+
   while True:  # when we run out of examples, shuffle and continue
-    for train_batch in get_minibatch(train_data, batch_size=config.batch_size):
+    for inputs, targets, lengths_in_batch in train_loader:
 
       # Only for time measurement of step through network
       t1 = time.time()
@@ -198,7 +182,8 @@ def train(config):
       model.train()
       optimizer.zero_grad()
 
-      inputs, targets, lengths_in_batch = prepare_minibatch(train_batch, vocab)
+      inputs = inputs.to(device, non_blocking=True)
+      targets = targets.to(device, non_blocking=True)
 
       # zeros in dim = (num_layer*num_direction * batch * lstm_hidden_size)
       # we have bidrectional single layer LSTM
@@ -226,7 +211,8 @@ def train(config):
       print('At iter', iter_i, ', rc_loss=',
             reconstruction_loss.item(), ' KL_loss = ', KL_loss.item())
 
-      total_loss = (reconstruction_loss + KL_loss) / config.batch_size
+      # the mean over the sentences of the batch, whose number varies with max_tokens_per_batch
+      total_loss = (reconstruction_loss + KL_loss) / inputs.size(0)
       tmp_loss.append(total_loss.item())
       total_loss.backward()
       torch.nn.utils.clip_grad_norm_(
@@ -234,100 +220,29 @@ def train(config):
       optimizer.step()
 
       if iter_i % config.eval_every == 0:
-        eval_data = val_data
+        eval_dataset, eval_batches = val_dataset, val_batches
         eval_data_flag = 'val'
         print('Evaluating with validation at iteration ', iter_i, '...')
 
         if iter_i % config.eval_every_train == 0:
-          eval_data = train_data
+          eval_dataset, eval_batches = train_dataset, train_eval_batches
           eval_data_flag = 'train'
           print('Evaluating with training instead, at iteration ', iter_i, '...')
 
-        model.eval()
-
-        ppl_total = 0.0
-        validation_elbo_loss = 0.0
-        validation_lengths = list()
-        nll_per_eval = list()
-        match = list()
-
-        with torch.no_grad():
-          # computing ppl, match, and accuracy
-          for validation_th, val_sen in enumerate(eval_data):
-            val_input, val_target = prepare_example(val_sen, vocab)
-
-            # zeros in dim = (num_layer*num_direction,
-            # batch=config.importance_sampling_size,  lstm_hidden_size)
-            h_0 = torch.zeros(
-                config.lstm_num_layers *
-                config.lstm_num_direction,
-                config.importance_sampling_size,
-                config.lstm_num_hidden).to(device)
-            c_0 = torch.zeros(
-                config.lstm_num_layers *
-                config.lstm_num_direction,
-                config.importance_sampling_size,
-                config.lstm_num_hidden).to(device)
-
-            # append the sent length of this particular validation example
-            validation_lengths.append(val_input.size(1))
-
-            # feed into models
-            decoder_output, KL_loss_validation = model(
-                val_input, h_0, c_0, [
-                    val_input.size(1)], config.importance_sampling_size)
-
-            # decoder_output.size() = (k, batchsize=1, val_input.size(1)(ie sent_length), vocabsize)
-            # prediction.size() = (k, sent_len, vocabsize)
-            # prediction_mean.size() = (sent_len, vocabsize), ie averaged over
-            # k samples (and squeezed)
-            prediction = nn.functional.softmax(
-                torch.squeeze(decoder_output, dim=1), dim=2)
-            prediction_mean = torch.mean(prediction, 0)  # averaged over k
-
-            ppl_per_example = 0.0
-            # sentence length, ie 1 word/1 timestamp for each loop
-            for j in range(prediction.shape[1]):
-              # 0 as the target is the same for the k samples
-              ppl_per_example -= torch.log(
-                  prediction_mean[j][int(val_target[0][j])])
-
-            ppl_total += ppl_per_example
-
-            if validation_th % 300 == 0:
-              print('    ppl_per_example at the ', validation_th,
-                    eval_data_flag, 'case = ', ppl_per_example)
-
-            tmp_match = compute_match_vae(prediction_mean, val_target)
-            match.append(tmp_match)
-
-            # calculate validation elbo
-            # decoder_output.size() = (k, batchsize=1, val_input.size(1)(ie sent_length), vocabsize)
-            # the first argument for criterion, ie, crossEntrooy must be (batch, classes(ie vocab size), sent_length), so we need to permute the last two dimension of decoder_output  to get (k, batchsize=1, vocab_classes, sent_length)
-            # then we loop over k to get (1, vocab_classes, sent_len)
-            decoder_output_validation = decoder_output.permute(0, 1, 3, 2)
-
-            reconstruction_loss = 0
-
-            for k in range(config.importance_sampling_size):
-              reconstruction_loss += criterion(
-                  decoder_output_validation[k], val_target)
-
-            validation_elbo_loss += (reconstruction_loss + \
-                                     KL_loss_validation) / config.importance_sampling_size
-
-            nll_per_eval.append(ppl_per_example)
-
-        ppl_total = torch.exp(ppl_total / sum(validation_lengths))
+        # computing ppl, match, and accuracy
+        nll, validation_length, match, validation_elbo_loss = evaluate(
+            model, eval_batches, config)
+
+        ppl_total = np.exp(nll / validation_length)
         print('ppl_total for iteration ', iter_i, ' =  ', ppl_total)
 
-        accuracy = sum(match) / sum(validation_lengths)
+        accuracy = match / validation_length
         print('accuracy for iteration ', iter_i, ' =  ', accuracy)
 
         # loss of the previous iterations (up the after last eval)
         avg_loss = sum(tmp_loss) / len(tmp_loss)
         tmp_loss = list()  # reinitialize to zero
-        validation_elbo_loss = validation_elbo_loss / len(val_data)
+        validation_elbo_loss = validation_elbo_loss / len(eval_dataset)
 
         if ppl_total < best_perp:
           best_perp = ppl_total
@@ -337,8 +252,6 @@ def train(config):
           # model_saved_name = datetime.now().strftime("%Y-%m-%d_%H%M") + './models/vae_best.pt'
           # torch.save(model.state_dict(), model_saved_name)
 
-        nll = sum(nll_per_eval)
-
         print(
             "[{}] Train Step {:04d}/{:04d}, "
             "Validation Perplexity = {:.4f}, Validation loss ={:.4f}, Training Loss = {:.4f}, NLL = {:.4f}"
@@ -361,7 +274,7 @@ def train(config):
         if eval_data_flag == 'val':
           val_perp.append(ppl_total.item())
           val_acc.append(accuracy)
-          val_elbo.append(validation_elbo_loss.item())
+          val_elbo.append(validation_elbo_loss)
           val_nll.append(nll)
 
           np.save('./np_saved_results/val_perp.npy',
@@ -376,7 +289,7 @@ def train(config):
         if eval_data_flag == 'train':
           train_perp.append(ppl_total.item())
           train_acc.append(accuracy)
-          train_elbo.append(validation_elbo_loss.item())
+          train_elbo.append(validation_elbo_loss)
           train_nll.append(nll)
 
           np.save('./np_saved_results/train_perp.npy',
@@ -400,84 +313,15 @@ def train(config):
   print('Testing...')
   print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
   model.load_state_dict(torch.load('./models/vae_best.pt'))
-  model.eval()
+  test_batches = prepare_batches(test_dataset, config.eval_batch_size)
+  nll, validation_length, match, validation_elbo_loss = evaluate(
+      model, test_batches, config)
 
-  ppl_total = 0.0
-  validation_elbo_loss = 0.0
-  validation_lengths = list()
-  nll_per_eval = list()
-  match = list()
+  ppl_total = np.exp(nll / validation_length)
 
-  with torch.no_grad():
-    # computing ppl, match, and accuracy
-    # too large too slow lets stick with first 1000/1700 first
-    for validation_th, val_sen in enumerate(test_data):
-      val_input, val_target = prepare_example(val_sen, vocab)
-
-      # zeros in dim = (num_layer*num_direction,
-      # batch=config.importance_sampling_size,  lstm_hidden_size)
-      h_0 = torch.zeros(
-          config.lstm_num_layers *
-          config.lstm_num_direction,
-          config.importance_sampling_size,
-          config.lstm_num_hidden).to(device)
-      c_0 = torch.zeros(
-          config.lstm_num_layers *
-          config.lstm_num_direction,
-          config.importance_sampling_size,
-          config.lstm_num_hidden).to(device)
-
-      # append the sent length of this particular validation example
-      validation_lengths.append(val_input.size(1))
-
-      # feed into models
-      decoder_output, KL_loss_validation = model(
-          val_input, h_0, c_0, [
-              val_input.size(1)], config.importance_sampling_size)
-
-      # decoder_output.size() = (k, batchsize=1, val_input.size(1)(ie sent_length), vocabsize)
-      # prediction.size() = (k, sent_len, vocabsize)
-      # prediction_mean.size() = (sent_len, vocabsize), ie averaged over k
-      # samples (and squeezed)
-      prediction = nn.functional.softmax(
-          torch.squeeze(decoder_output, dim=1), dim=2)
-      prediction_mean = torch.mean(prediction, 0)  # averaged over k
-
-      ppl_per_example = 0.0
-      # sentence length, ie 1 word/1 timestamp for each loop
-      for j in range(prediction.shape[1]):
-        # 0 as the target is the same for the k samples
-        ppl_per_example -= torch.log(prediction_mean[j][int(val_target[0][j])])
-
-      ppl_total += ppl_per_example
-
-      tmp_match = compute_match_vae(prediction_mean, val_target)
-      match.append(tmp_match)
-
-      # calculate validation elbo
-      # decoder_output.size() = (k, batchsize=1, val_input.size(1)(ie sent_length), vocabsize)
-      # the first argument for criterion, ie, crossEntrooy must be (batch, classes(ie vocab size), sent_length), so we need to permute the last two dimension of decoder_output  to get (k, batchsize=1, vocab_classes, sent_length)
-      # then we loop over k to get (1, vocab_classes, sent_len)
-      decoder_output_validation = decoder_output.permute(0, 1, 3, 2)
-
-      reconstruction_loss = 0
+  accuracy = match / validation_length
 
-      for k in range(config.importance_sampling_size):
-        reconstruction_loss += criterion(
-            decoder_output_validation[k], val_target)
-
-      validation_elbo_loss += (reconstruction_loss + \
-                               KL_loss_validation) / config.importance_sampling_size
-
-      nll_per_eval.append(ppl_total)
-
-  ppl_total = torch.exp(ppl_total / sum(validation_lengths))
-
-  accuracy = sum(match) / sum(validation_lengths)
-
-  validation_elbo_loss = validation_elbo_loss / len(test_data)
-
-  nll = sum(nll_per_eval)
+  validation_elbo_loss = validation_elbo_loss / len(test_dataset)
 
   print('Test Perplexity on the best model is: {:.3f}'.format(ppl_total))
   print('Test ELBO on the best model is: {:.3f}'.format(validation_elbo_loss))
@@ -557,7 +401,7 @@ def train(config):
 
   print('Test case reconstruction...')
   print('+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-')
-  test_sen = test_data[101]
+  test_sen = test_set.sentence(101)
   # print('test_sen', test_sen)
   test_input, _ = prepare_example(test_sen, vocab)
   # print('test_input',test_input)
@@ -654,8 +498,14 @@ if __name__ == "__main__":
                         help='latent size of the input')
     parser.add_argument('--batch_size', type=int, default=32,
                         help='Batch size of the input')
+    parser.add_argument('--bucket_width', type=int, default=1,
+                        help='Width of the length buckets the batches are drawn from')
+    parser.add_argument('--max_tokens_per_batch', type=int, default=None,
+                        help='Fill the batches up to this many (padded) tokens instead of batch_size sentences')
 
     # Training params
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of DataLoader processes preparing the batches')
     parser.add_argument('--learning_rate', type=float,
                         default=2e-3, help='Learning rate')
     parser.add_argument('--dropout_keep_prob', type=float,
@@ -676,6 +526,8 @@ if __name__ == "__main__":
         type=int,
         default=500,
         help='How often to print and evaluate training progress using whole train split')
+    parser.add_argument('--eval_batch_size', type=int, default=16,
+                        help='Batch size of the evaluation, every sentence is decoded importance_sampling_size times')
     parser.add_argument('--sample_size', type=int, default=10,
                         help='Number of sampled sentences')
 
@@ -685,6 +537,17 @@ if __name__ == "__main__":
         type=int,
         default=2,
         help='Number of z sampled per validation example for importances sampling')
+    parser.add_argument(
+        '--perplexity_estimator',
+        type=str,
+        default='mean',
+        choices=['mean', 'iwae'],
+        help='mean: average the word probabilities of the importance_sampling_size samples, '
+             'iwae: importance weighted estimate of log p(x) with iwae_samples samples')
+    parser.add_argument('--iwae_samples', type=int, default=1000,
+                        help='Number of z sampled per sentence by the iwae estimator')
+    parser.add_argument('--iwae_chunk_size', type=int, default=50,
+                        help='Number of those samples decoded at once, bounds the memory use')
 
     config = parser.parse_args()
 